@@ -4,10 +4,23 @@ VERSION="0.5.0" # MAJOR.MINOR.PATCH | http://semver.org
 
 from collections import defaultdict
 from collections import OrderedDict
+from collections import namedtuple
+from collections import ChainMap
+from collections import deque
 from io import open
+from contextlib import redirect_stdout
+from contextlib import contextmanager
+from contextlib import nullcontext
+from xml.sax.saxutils import escape
+
+import concurrent.futures
+import io
+import json
+import sqlite3
+import threading
+import time
 
 import zipfile
-import wave
 import math
 import re
 import os
@@ -15,6 +28,21 @@ import sys
 import operator
 import struct
 import argparse
+import copy
+import functools
+import zlib
+import mmap
+import hashlib
+
+
+# Parsed #include fragments, shared by every conversion run by this process
+FRAGMENT_CACHE = {}
+
+# Compressed sample entries already written to a multisample by this process, reused by later multisamples
+ENTRY_STORE = {}
+
+# Content digests of samples, keyed by (path, size, mtime)
+CONTENT_DIGESTS = {}
 
 
 def parse_commandline():
@@ -25,276 +53,893 @@ def parse_commandline():
     parser.add_argument('--creator', default='sfz2bitwig', help='set creator field of generated multisample')
     parser.add_argument('--description', default='', help='set description field of generated multisample')
     parser.add_argument('--keywords', default='', nargs='*', help='set keywords field of generated multisample')
-    parser.add_argument('sfzfile', nargs='+', help='sfz file(s) to convert')
-
-    return parser.parse_args()
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='number of sfz files to convert in parallel (0 uses all cpus)')
+    parser.add_argument('--cache-dir', default=defaultcachedir(), help='directory of the persistent wav metadata cache (default: %(default)s)')
+    parser.add_argument('--cache-size', default=200000, type=int, help='maximum number of samples kept in the metadata cache, least recently used are evicted first')
+    parser.add_argument('--no-cache', default=False, action='store_true', help='do not read or update the wav metadata cache')
+    parser.add_argument('--clear-cache', default=False, action='store_true', help='empty the wav metadata cache before converting')
+    parser.add_argument('--compression', default='deflate', choices=['store', 'deflate', 'auto'], help='how samples are stored in the multisample, auto deflates a probe of each sample and stores it uncompressed when that saves little (default: %(default)s)')
+    parser.add_argument('--compresslevel', default=None, type=int, choices=range(0, 10), metavar='{0-9}', help='deflate level for samples, lower is faster (default: zlib default)')
+    parser.add_argument('--slice', default=False, action='store_true', help='store only the frames played by regions using offset/end instead of their whole wav')
+    parser.add_argument('--dedup-content', default=False, action='store_true', help='store byte-identical wavs with different names only once')
+    parser.add_argument('--probe-threads', default=8, type=int, help='threads reading wav headers concurrently, helps on network storage (default: %(default)s)')
+    parser.add_argument('--threads', default=0, type=int, help='threads compressing the samples of one multisample (default: all cpus, or 1 with --jobs)')
+    parser.add_argument('--inflight', default=None, type=int, help='maximum number of compressed samples held in memory waiting to be written (default: 2 per thread)')
+    parser.add_argument('--incremental', default=False, action='store_true', help='skip sfz files whose multisample is up to date, and only rewrite multisample.xml when no sample changed')
+    parser.add_argument('--stats', default=False, action='store_true', help='print the time spent in each conversion phase and the i/o done for each sfz file')
+    parser.add_argument('--report', default=None, metavar='FILE.json', help='write conversion statistics of every sfz file to a json file')
+    parser.add_argument('--watch', default=None, metavar='DIR', help='convert the sfz files below DIR, then keep reconverting those whose sfz, includes or samples change (implies --incremental)')
+    parser.add_argument('--interval', default=0.5, type=float, help='seconds between checks for changes with --watch (default: %(default)s)')
+    parser.add_argument('--library', default=None, metavar='ROOT', help='convert every sfz file below ROOT, resuming an earlier interrupted run from its journal')
+    parser.add_argument('--journal', default=None, help='journal recording the progress of --library (default: ROOT/.sfz2bitwig-journal)')
+    parser.add_argument('--restart', default=False, action='store_true', help='ignore the journal of --library and convert every sfz file again')
+    parser.add_argument('sfzfile', nargs='*', help='sfz file(s) to convert')
+
+    args = parser.parse_args()
+    if not args.sfzfile and not args.clear_cache and not args.watch and not args.library:
+        parser.error('the following arguments are required: sfzfile')
+
+    return args
+
+
+def defaultcachedir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'sfz2bitwig')
 
 
 def main():
     args = parse_commandline()
 
-    for fn in args.sfzfile:
-        # Convert file
-        multisamp = Multisample(category=args.category, creator=args.creator, description=args.description, keywords=args.keywords )
-        multisamp.initFromSFZ(fn,args.noloop)
-        multisamp.write()
+    if args.clear_cache:
+        cache = opencache(args.cache_dir)
+        if cache:
+            cache.clear()
+            cache.close()
+            print("Cleared wav metadata cache {}".format(cache.path))
+
+    if args.watch:
+        return watch(args)
+
+    sfzfiles = list(args.sfzfile)
+    journal = None
+    if args.library:
+        journal = Journal(args.journal or os.path.join(args.library, '.sfz2bitwig-journal'), restart=args.restart)
+        found = findsfzfiles(args.library)
+        pending = [fn for fn in found if not journal.isdone(fn)]
+        if len(pending) < len(found):
+            print("Resuming {}: {} of {} sfz files were converted by an earlier run".format(args.library, len(found) - len(pending), len(found)))
+        sfzfiles += pending
+
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    results = []
+
+    def finished(result, capture=False):
+        if capture:
+            sys.stdout.write(result['output'])
+            sys.stdout.flush()
+        results.append(result)
+        if journal:
+            journal.record(result)
+
+    try:
+        if jobs == 1 or len(sfzfiles) == 1:
+            for fn in sfzfiles:
+                finished(convert(fn, args))
+        else:
+            # Each worker captures its own console output, print it in one piece once the file is done
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+            futures = [executor.submit(convert, fn, args, True) for fn in sfzfiles]
+            pending = set(futures)
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    pending.discard(future)
+                    finished(future.result(), True)
+            except KeyboardInterrupt:
+                # Drop the queued files instead of waiting for them, but keep the work of those that completed meanwhile.
+                # Futures are cancelled here too, the executor only cancels them once its manager thread gets to run.
+                executor.shutdown(wait=False, cancel_futures=True)
+                for future in futures:
+                    future.cancel()
+                for future in futures:
+                    if future in pending and future.done() and not future.cancelled() and future.exception() is None:
+                        finished(future.result(), True)
+                raise
+            executor.shutdown()
+    except KeyboardInterrupt:
+        print("\nInterrupted after converting {} of {} sfz files{}".format(len(results), len(sfzfiles), ", run again to resume" if journal else ""))
+        return 130
+
+    if len(results) > 1:
+        printbatchsummary(results)
+
+    if args.report:
+        writereport(args.report, results)
+
+    return 1 if any(r['error'] for r in results) else 0
+
+
+def convert(fn, args, capture=False, cache=None):
+    """Convert a single sfz file, returning a summary dict. Errors are reported rather than raised so a batch can continue.
+
+    A SampleCache opened by the caller is used as is and left open, otherwise the cache is opened for this file.
+    """
+    result = {'sfzfile': fn, 'output': '', 'error': None, 'skipped': False, 'samples': 0, 'regions': 0, 'opcodes_ignored': {}, 'inputs': [fn]}
+    sharedcache = cache
+    out = io.StringIO() if capture else sys.stdout
+    stats = ConversionStats() if args.stats or args.report else NULL_STATS
+
+    with redirect_stdout(out), stats.phase('other'):
+        multisamp = None
+        try:
+            options = buildoptions(args)
+            if args.incremental and isuptodate(multisampleoutpath(fn), options):
+                print("\nSkipping {}, {} is up to date".format(fn, multisampleoutpath(fn)))
+                result['skipped'] = True
+                result['inputs'] = list(readmanifest(multisampleoutpath(fn))['inputs'])
+            else:
+                if cache is None and not args.no_cache:
+                    cache = opencache(args.cache_dir, args.cache_size)
+                multisamp = Multisample(category=args.category, creator=args.creator, description=args.description, keywords=args.keywords, cache=cache, fragmentcache=FRAGMENT_CACHE,
+                                        compression=CompressionPolicy(args.compression, args.compresslevel), sliceregions=args.slice,
+                                        dedupcontent=args.dedup_content, entrystore=ENTRY_STORE, stats=stats )
+                multisamp.initFromSFZ(fn,args.noloop,args.probe_threads)
+                threads = args.threads or ((os.cpu_count() or 1) if args.jobs == 1 else 1)
+                multisamp.write(incremental=args.incremental, options=options, threads=threads, inflight=args.inflight)
+                result['samples'] = len(multisamp.samples)
+                result['regions'] = multisamp.region_count
+                result['opcodes_ignored'] = dict(multisamp.opcodes_ignored)
+        except Exception as e:
+            result['error'] = "{}: {}".format(type(e).__name__, e)
+            print("\nERROR: Failed to convert {}: {}".format(fn, result['error']))
+        finally:
+            if multisamp is not None:
+                result['inputs'] = list(OrderedDict.fromkeys([fn] + multisamp.inputfiles()))
+            if cache and cache is not sharedcache:
+                cache.close()
+
+    if stats.enabled:
+        result['stats'] = stats.report(multisamp, cache)
+        if args.stats:
+            with redirect_stdout(out):
+                stats.printsummary()
+
+    if capture:
+        result['output'] = out.getvalue()
+
+    return result
+
+
+def opencache(cachedir, maxentries=200000):
+    """Open the wav metadata cache, or warn and return None when it cannot be used. The cache is optional."""
+    try:
+        return SampleCache(cachedir, maxentries)
+    except (OSError, sqlite3.Error) as e:
+        print("WARNING: Could not open wav metadata cache in {}, continuing without it: {}".format(cachedir, e))
+        return None
+
+
+def watch(args):
+    """Convert the sfz files below args.watch, then poll for changes and reconvert only the instruments whose sfz, includes or
+    samples changed, until interrupted. Parsed includes, wav metadata and compressed samples stay in memory between rebuilds."""
+    args = argparse.Namespace(**dict(vars(args), incremental=True))
+    cache = None if args.no_cache else opencache(args.cache_dir, args.cache_size)
+    instruments = {}        # sfz file -> {input path: fingerprint} of its last conversion
+    failed = set()
+
+    print("Watching {} for changes, press Ctrl-C to stop".format(args.watch))
+    try:
+        while True:
+            sfzfiles = findsfzfiles(args.watch)
+            for fn in set(instruments) - set(sfzfiles):
+                del instruments[fn]
+                failed.discard(fn)
+
+            # Samples shared by several instruments are only stat'ed once per poll
+            fingerprints = FingerprintMemo()
+            changed = [fn for fn in sfzfiles if fn not in instruments or any(fingerprints[path] != fp for path, fp in instruments[fn].items())]
+            if changed:
+                # Instruments that failed are retried whenever anything changes, the fix may be in a file they did not get to read
+                retry = [fn for fn in sorted(failed) if fn not in changed]
+                start = time.perf_counter()
+                for fn in changed + retry:
+                    result = convert(fn, args, cache=cache)
+                    instruments[fn] = {path: fingerprints[path] for path in result['inputs']}
+                    if result['error']:
+                        failed.add(fn)
+                    else:
+                        failed.discard(fn)
+                prunecaches(fingerprints, cache)
+                if cache:
+                    cache.flush()
+                print("\nRebuilt {} sfz file(s) in {:.2f} s, {} failed. Watching {} for changes".format(len(changed + retry), time.perf_counter() - start, len(failed), args.watch))
+
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print("\nStopped watching {}".format(args.watch))
+    finally:
+        if cache:
+            cache.close()
+
+    return 1 if failed else 0
+
+
+class FingerprintMemo(dict):
+    """pollfingerprint of each path looked up, the file is stat'ed on the first lookup only."""
+    def __missing__(self, path):
+        fp = self[path] = pollfingerprint(path)
+        return fp
+
+
+def prunecaches(fingerprints, cache=None):
+    """Drop the entries of the process wide caches, and of the wav metadata cache, made from files that have changed or
+    disappeared since. fingerprints is a FingerprintMemo."""
+    def current(stat):
+        return list(stat) if stat is not None else None
+
+    for path, fragments in list(FRAGMENT_CACHE.items()):
+        fragments = [fragment for fragment in fragments if fingerprints[path] == current(fragment.stat)
+                     and all(fingerprints[include] == current(stat) for include, stat in fragment.includes.items())]
+        if fragments:
+            FRAGMENT_CACHE[path] = fragments
+        else:
+            del FRAGMENT_CACHE[path]
+
+    for key, (zippath, zipfingerprint, zinfo) in list(ENTRY_STORE.items()):
+        if fingerprints[key[0]] != list(key[1]) or fingerprints[zippath] != zipfingerprint:
+            del ENTRY_STORE[key]
+
+    for key in list(CONTENT_DIGESTS):
+        if fingerprints[key[0]] != list(key[1:]):
+            del CONTENT_DIGESTS[key]
+
+    if cache:
+        cache.prune(lambda path: fingerprints[path])
+
+
+class Journal(object):
+    """Progress of a library conversion, one json line per converted sfz file and the last line of a file wins.
+
+    Lines are appended as each sfz file finishes, so a run that crashes or is interrupted leaves a journal from which the
+    next run resumes, converting only the files that are missing, failed or changed since.
+    """
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.entries = {}
+
+        if not restart:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue                                    # line cut short by an interrupted run
+                        self.entries[entry['sfzfile']] = entry
+            except OSError:
+                pass
 
-    return
+        # Start from a compacted copy, which also drops a partially written last line
+        tmppath = "{}.tmp".format(path)
+        with open(tmppath, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+        os.replace(tmppath, path)
+
+    def isdone(self, sfzfile):
+        """True when sfzfile was converted by an earlier run, has not changed since and its multisample still exists."""
+        entry = self.entries.get(os.path.abspath(sfzfile))
+        return bool(entry) and entry['status'] == 'done' and entry['fingerprint'] == pollfingerprint(sfzfile) \
+            and os.path.exists(multisampleoutpath(sfzfile))
+
+    def record(self, result):
+        sfzfile = os.path.abspath(result['sfzfile'])
+        entry = self.entries[sfzfile] = {
+            'sfzfile': sfzfile,
+            'status': 'failed' if result['error'] else 'done',
+            'error': result['error'],
+            'fingerprint': pollfingerprint(result['sfzfile']),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def findsfzfiles(root):
+    """Paths of the sfz files below root, in a stable order."""
+    sfzfiles = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        sfzfiles.extend(os.path.join(dirpath, name) for name in sorted(filenames) if name.lower().endswith('.sfz'))
+    return sfzfiles
+
+
+def pollfingerprint(path):
+    try:
+        return fingerprint(path)
+    except OSError:
+        return None
+
+
+def buildoptions(args):
+    """Options that affect the generated multisample, recorded in the build manifest."""
+    return {'category': args.category, 'creator': args.creator, 'description': args.description, 'keywords': args.keywords, 'noloop': args.noloop,
+            'compression': args.compression, 'compresslevel': args.compresslevel, 'slice': args.slice,
+            'dedup_content': args.dedup_content}
+
+
+def writereport(path, results):
+    """Write the statistics gathered for each sfz file of a batch to the json file path."""
+    files = [{k: v for k, v in r.items() if k != 'output'} for r in results]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'version': VERSION, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'files': files}, f, indent=1, sort_keys=True)
+
+
+def printbatchsummary(results):
+    failed = [r for r in results if r['error']]
+    opcodes_ignored = defaultdict(int)
+    for r in results:
+        for k, v in r['opcodes_ignored'].items():
+            opcodes_ignored[k] += v
+
+    print("\nBatch Results:")
+    print("  {} of {} sfz files converted".format(len(results) - len(failed), len(results)))
+    skipped = sum(1 for r in results if r['skipped'])
+    if skipped:
+        print("  {} multisamples were already up to date".format(skipped))
+    print("  {} samples mapped from {} regions".format(sum(r['samples'] for r in results), sum(r['regions'] for r in results)))
+    print("  {} SFZ opcodes were lost in translation ({} distinct)".format(sum(opcodes_ignored.values()), len(opcodes_ignored)))
+
+    if failed:
+        print("\n  Failed to convert:")
+        for r in failed:
+            print("    {}  ({})".format(r['sfzfile'], r['error']))
+
+
+def convertsfz(sfz, output=None, events=None, basedir=None, name=None, noloop=False, category='', creator='sfz2bitwig', description='', keywords=None,
+               compression='deflate', compresslevel=None, sliceregions=False, dedupcontent=False, cache=None, threads=1, probethreads=1):
+    """Convert an sfz instrument into a multisample without printing anything, for use as a library.
+
+    sfz is the path of an sfz file or a file object reading one, in which case samples are found relative to basedir
+    (default: the current directory). The multisample is returned as bytes when output is None, otherwise it is written
+    to output, a path or a writable binary file object, and the Multisample is returned. events is called with a
+    ConversionEvent for every message the command line tool would print. A SampleCache given as cache is flushed after
+    the conversion, a failure to update it is reported as an event too. Errors are raised.
+    """
+    multisamp = Multisample(category=category, creator=creator, description=description, keywords=keywords, cache=cache, fragmentcache=FRAGMENT_CACHE,
+                            compression=CompressionPolicy(compression, compresslevel), sliceregions=sliceregions, dedupcontent=dedupcontent,
+                            events=events or ignoreevent)
+    multisamp.initFromSFZ(sfz, noloop, probethreads, basedir=basedir)
+    if name:
+        multisamp.name = name
+
+    if output is None:
+        out = io.BytesIO()
+        multisamp.write(out, threads=threads)
+    else:
+        multisamp.write(output, threads=threads)
+
+    if cache is not None:
+        cache.flush(warn=lambda message: multisamp.emit('warning', 'cache-not-updated', message, path=cache.path))
+
+    return out.getvalue() if output is None else multisamp
+
+
+# Something that happened during a conversion. level is 'info', 'warning' or 'error', kind identifies the event (e.g.
+# 'loop-extracted', 'opcodes-ignored'), message is the text printed by the command line tool and details a dict of values.
+ConversionEvent = namedtuple('ConversionEvent', ['level', 'kind', 'message', 'details'])
+
+def printevent(event):
+    print(event.message)
+
+def ignoreevent(event):
+    pass
 
 
 class Multisample(object):
-    def __init__(self, name='default', category='', creator='', description='', keywords=None ):
+    def __init__(self, name='default', category='', creator='', description='', keywords=None, cache=None, fragmentcache=None, compression=None, sliceregions=False, dedupcontent=False, entrystore=None, stats=None, events=None ):
         self.name = name
         self.category = category
         self.creator = creator
         self.description = description
         self.keywords = keywords
         self.samples = []
+        self.region_count = 0
+        self.opcodes_ignored = {}
+        self.cache = cache
+        self.fragmentcache = fragmentcache
+        self.compression = compression or CompressionPolicy()
+        self.compressionstats = None
+        self.sliceregions = sliceregions
+        self.dedupcontent = dedupcontent
+        self.entrystore = entrystore
+        self.sampleids = set()
+        self.contentids = {}
+        self.entrynames = {}
+        self.entrykeys = {}
+        self.sfzfile = None
+        self.sourcefiles = []
+        self.missingincludes = []
+        self.samplepaths = []
+        self.stats = stats or NULL_STATS
+        self.events = events or printevent
         pass
 
-    def initFromSFZ(self, sfzfile, noloop=False):
-        cur_global_defaults = {}
+    def initFromSFZ(self, sfzfile, noloop=False, threads=1, basedir=None):
+        """Read the regions of sfzfile, a path or a file object. Relative sample paths are resolved against basedir,
+        by default the directory of the sfz file."""
         cur_control_defaults = {}
-        cur_group_defaults = {}
-        sfz_opcodes_ignored = defaultdict(int)
+        regions = RegionCompiler()
         region_count = 0
+        queued = []     # regions and events, in file order
 
-        print("\nConverting {} to multisample".format(sfzfile))
-        sfz = SFZParser(sfzfile)
+        sfz = SFZParser(sfzfile, fragment_cache=self.fragmentcache, basedir=basedir,
+                        warn=lambda message: queued.append(ConversionEvent('warning', 'include-missing', message, {})))
+        sfzfile = sfz.sfz_path
+        self.emit('info', 'converting', "\nConverting {} to multisample".format(sfzfile), sfzfile=sfzfile)
         #print("Finished parsing {}".format(sfzfile))
 
         self.name = "{}".format(os.path.splitext(sfzfile)[0])
+        self.sfzfile = sfzfile
 
-        for section in sfz.sections:
-            sectionName = section[0]
-            #print("start section <{}>".format(sectionName))
-            if sectionName == "control":
-                cur_control_defaults = {}
-                for k, v in section[1].items():
-                    cur_control_defaults[k] = v
-                    if k == "default_path":
-                        cur_control_defaults["default_path"] = os.path.join(os.path.dirname(os.path.abspath(sfzfile)),os.path.normpath(v.replace('\\','/')))
-
-                    #print("Set control default: {}={}".format(k,cur_control_defaults[k]))
-
-            elif sectionName == "group":
-                cur_group_defaults = {}
-                for k, v in section[1].items():
-                    cur_group_defaults[k] = v
-                    #print("Set group default: {}={}".format(k,v))
-
-            elif sectionName == "global":
-                cur_global_defaults = {}
-                for k, v in section[1].items():
-                    cur_global_defaults[k] = v
-                    #print("Set global default: {}={}".format(k,v))
-
-            elif sectionName == "region":
-                region_count += 1
-                newsample = {}
-
-                # Apply settings with priority global < group < region
-                opcodes = dict(cur_global_defaults)
-                opcodes.update(cur_group_defaults)
-                opcodes.update(section[1])
-
-                for k, v in opcodes.items():
-                    #print(" {}={}".format(k,v))
-                    if k == "sample":
-                        newsample['file'] = os.path.normpath(v.replace('\\','/'))
-                        if newsample['file'][0] == '/': # relative path should not contain leading slash
-                            newsample['file'] = newsample['file'][1:]
-                    elif k == "lokey":
-                        newsample['keylow'] = self.sfz_note_to_midi_key(v)
-                    elif k == "hikey":
-                        newsample['keyhigh'] = self.sfz_note_to_midi_key(v)
-                    elif k == "pitch_keycenter":
-                        newsample['root'] = self.sfz_note_to_midi_key(v)
-                    elif k == "key":
-                        newsample['keylow'] = self.sfz_note_to_midi_key(v)
-                        newsample['keyhigh'] = self.sfz_note_to_midi_key(v)
-                        newsample['root'] = self.sfz_note_to_midi_key(v)
-                    elif k == "pitch_keytrack":
-                        newsample['track'] = v
-                    elif k == "lovel":
-                        newsample['velocitylow'] = v
-                    elif k == "hivel":
-                        newsample['velocityhigh'] = v
-                    elif k == "volume":
-                        newsample['gain'] = v
-                    elif k == "tune":
-                        newsample['tune'] = int(v) * 0.01
-                    elif k == "loop_mode":
-                        if v != 'one_shot':
-                            newsample['loopmode'] = 'sustain' # bitwig currently supports off or sustain
-                    elif k == "loop_start":
-                        newsample['loopstart'] = v
-                    elif k == "loop_end":
-                        newsample['loopstop'] = v
-                    elif k == "trigger":
-                        newsample['trigger'] = v
-                    elif k == "lorand":
-                        if float(v) > 0.0:
-                            newsample['playlogic'] = "conditional"
-                    elif k == "hirand":
-                        if float(v) < 1.0:
-                            newsample['playlogic'] = "conditional"
-                    elif k == "seq_length":
-                        if int(v) > 1:
-                            newsample['playlogic'] = "conditional"
-                    else:
-                        sfz_opcodes_ignored["{}={}".format(k,v)] += 1
-
-                defaultPath = cur_control_defaults.get('default_path',os.path.dirname(os.path.abspath(sfzfile)))
-                newsampleFullPath = os.path.join(defaultPath,newsample['file'])
-                newsample['filepath'] = newsampleFullPath
-                newsample['sample-start'] = '0.000'
-                newsample['sample-stop'] = self.getsamplecount(newsampleFullPath)
-
-                if not noloop:
-                    # Check for loop points embedded in wav file, and specify them in multisample xml as bitwig wont load them from wav automatically
-                    if not newsample.get('loopstart',None) and not newsample.get('loopstop',None):
-                        metadata = self.readwavmetadata(newsampleFullPath,readloops=True)
-                        if metadata[0] and metadata[0][0]:
-                            newsample['loopmode'] = 'sustain'
-                            newsample['loopstart'] = metadata[0][0][0]
-                            newsample['loopstop'] = metadata[0][0][1]
-                            print("Extracted loop point ({},{}) from {}".format(newsample['loopstart'],newsample['loopstop'],newsample['file']))
-
-                if 'root' not in newsample and newsample.get('track','true') == 'true':
-                    print("ERROR: No pitch_keycenter for sample {}, root of sample will need to be manually adjusted in Bitwig".format(newsample['file']))
-                    newsample['root'] = 0 # bitwig defaults to c4 when root is not given, make the issue more obvious with a more extreme value
-
-                if newsample['filepath'] in [s['filepath'] for s in self.samples]:
-                    print("WARNING: Skipping duplicate sample: {} ({})".format(os.path.basename(newsample.get('file','')),newsample.get('filepath','')))
-
-                elif 'trigger' in newsample:
-                    # bitwig multisample only supports note-on events
-                    print("WARNING: Skipping sample with unhandled trigger event: trigger={}".format(newsample['trigger']))
+        with self.stats.phase('regions'):
+            for section in self.stats.iterate('parse', sfz):
+                sectionName = section[0]
+                #print("start section <{}>".format(sectionName))
+                if sectionName == "control":
+                    cur_control_defaults = {}
+                    for k, v in section[1].items():
+                        cur_control_defaults[k] = v
+                        if k == "default_path":
+                            cur_control_defaults["default_path"] = os.path.join(sfz.basedir,os.path.normpath(v.replace('\\','/')))
+
+                        #print("Set control default: {}={}".format(k,cur_control_defaults[k]))
 
+                elif sectionName == "group":
+                    regions.setgroup(section[1])
+
+                elif sectionName == "global":
+                    regions.setglobal(section[1])
+
+                elif sectionName == "region":
+                    region_count += 1
+                    newsample = regions.compile(section[1])
+
+                    if 'file' not in newsample:
+                        queued.append(ConversionEvent('warning', 'region-skipped', "WARNING: Skipping region without sample opcode", {'opcodes': dict(section[1])}))
+                        continue
+
+                    defaultPath = cur_control_defaults.get('default_path',sfz.basedir)
+                    newsample['filepath'] = os.path.join(defaultPath,newsample['file'])
+                    queued.append(newsample)
+
+                elif sectionName == "curve" or sectionName == "effect":
+                    regions.ignore(section[1])
                 else:
-                    self.samples.append(newsample)
-                    #print("Converted sample {}".format(newsample['file']))
-
-            elif sectionName == "curve":
-                    sfz_opcodes_ignored["{}={}".format(k,v)] += 1
-                    #print("WARNING: Ignoring SFZ opcode {}={}".format(k,v))
-            elif sectionName == "effect":
-                    sfz_opcodes_ignored["{}={}".format(k,v)] += 1
-                    #print("WARNING: Ignoring SFZ opcode {}={}".format(k,v))
-            elif sectionName == "comment":
-                pass
-            else:
-                print("WARNING: Unhandled section {}".format(sectionName))
-                sfz_opcodes_ignored["{}={}".format(k,v)] += 1
+                    queued.append(ConversionEvent('warning', 'section-unhandled', "WARNING: Unhandled section {}".format(sectionName), {'section': sectionName}))
+                    regions.ignore(section[1])
+
+        self.sourcefiles = ([sfzfile] if sfz.source is None else []) + sorted(sfz.includes)
+        self.missingincludes = sorted(sfz.missingincludes)
+        if self.stats.enabled:
+            for path in self.sourcefiles:
+                self.stats.count(files=1, read=os.path.getsize(path))
+
+        # Probe all samples up front so the wav headers can be read concurrently, then finish the regions in order
+        with self.stats.phase('probe'):
+            paths = self.samplepaths = [item['filepath'] for item in queued if not isinstance(item, ConversionEvent)]
+            misses = self.cache.misses if self.cache else 0
+            wavinfos = self.probesamples(paths, threads)
+            if self.dedupcontent:
+                self.contentids = self.identifysamples(paths, threads)
+            if self.stats.enabled:
+                self.stats.count(files=(self.cache.misses - misses) if self.cache else len(wavinfos))
+                for path in self.contentids:
+                    self.stats.count(files=1, read=os.path.getsize(path))
+        with self.stats.phase('regions'):
+            for item in queued:
+                if isinstance(item, ConversionEvent):
+                    self.events(item)
+                else:
+                    self.addsample(item, wavinfos[item['filepath']], noloop)
+
+        sfz_opcodes_ignored = { "{}={}".format(k,v): count for (k, v), count in regions.ignored().items() }
 
-        print("Finished converting {} to multisample".format(sfzfile))
-        print("\nConversion Results:")
-        print("  {} samples mapped from {} regions".format(len(self.samples),region_count))
+        self.region_count = region_count
+        self.opcodes_ignored = sfz_opcodes_ignored
+        self.emit('info', 'converted', "Finished converting {} to multisample".format(sfzfile), sfzfile=sfzfile)
+        self.emit('info', 'results', "\nConversion Results:\n  {} samples mapped from {} regions".format(len(self.samples),region_count), samples=len(self.samples), regions=region_count)
 
         if sfz_opcodes_ignored:
             sfz_opcodes_ignored_count = 0
             for k, v in sfz_opcodes_ignored.items():
                 sfz_opcodes_ignored_count += v
 
-            print("\n  {} SFZ opcodes were lost in translation:".format(sfz_opcodes_ignored_count))
+            lines = ["\n  {} SFZ opcodes were lost in translation:".format(sfz_opcodes_ignored_count)]
             sorted_sfz_opcodes_ignored = sorted(sfz_opcodes_ignored.items(), key=operator.itemgetter(1), reverse=True)
 
             for v in sorted_sfz_opcodes_ignored:
-                print("    ({})  {}".format(v[1],v[0]))
+                lines.append("    ({})  {}".format(v[1],v[0]))
+            self.emit('warning', 'opcodes-ignored', "\n".join(lines), opcodes=dict(sfz_opcodes_ignored))
 
         sfz_ahdsr_opcodes = ['ampeg_release', 'ampeg_sustain', 'ampeg_hold', 'ampeg_decay', 'ampeg_attack']
         suggest_ahdsr = { k: v for k, v in sfz_opcodes_ignored.items() if k.split('=')[0] in sfz_ahdsr_opcodes }
         if suggest_ahdsr:
-            print("\n  Suggested Bitwig sampler AHDSR settings:")
+            lines = ["\n  Suggested Bitwig sampler AHDSR settings:"]
             ahdsr = self.getbestahdsr(suggest_ahdsr)
             if ahdsr['attack'][0]:
-                print("    ({})  A = {} s".format(ahdsr['attack'][1],ahdsr['attack'][0]))
+                lines.append("    ({})  A = {} s".format(ahdsr['attack'][1],ahdsr['attack'][0]))
             if ahdsr['hold'][0]:
-                print("    ({})  H = {} %".format(ahdsr['hold'][1],ahdsr['hold'][0]))
+                lines.append("    ({})  H = {} %".format(ahdsr['hold'][1],ahdsr['hold'][0]))
             if ahdsr['decay'][0]:
-                print("    ({})  D = {} s".format(ahdsr['decay'][1],ahdsr['decay'][0]))
+                lines.append("    ({})  D = {} s".format(ahdsr['decay'][1],ahdsr['decay'][0]))
             if ahdsr['sustain'][0]:
-                print("    ({})  S = {} %".format(ahdsr['sustain'][1],ahdsr['sustain'][0]))
+                lines.append("    ({})  S = {} %".format(ahdsr['sustain'][1],ahdsr['sustain'][0]))
             if ahdsr['release'][0]:
-                print("    ({})  R = {} s".format(ahdsr['release'][1],ahdsr['release'][0]))
+                lines.append("    ({})  R = {} s".format(ahdsr['release'][1],ahdsr['release'][0]))
+            self.emit('info', 'ahdsr-suggested', "\n".join(lines), ahdsr={k: v[0] for k, v in ahdsr.items() if v[0]})
+
+    def inputfiles(self):
+        """Files the multisample is built from: the sfz file, its includes and the wavs of its regions, also when they are missing.
+        Includes that could not be found are listed too, creating one changes the multisample."""
+        return list(OrderedDict.fromkeys(self.sourcefiles + self.missingincludes + self.samplepaths))
+
+    def addsample(self, newsample, wavinfo, noloop=False):
+        if isinstance(wavinfo, Exception):
+            raise wavinfo
+
+        # offset/end select the frames of the wav played by the region, end is the last frame played
+        end = newsample.get('end')
+        stop = wavinfo.framecount if end is None or end < 0 else min(end + 1, wavinfo.framecount)
+        start = min(newsample.get('offset', 0), stop)
+        newsample['frames'] = (start, stop)
+        newsample['sample-start'] = start if start else '0.000'
+        newsample['sample-stop'] = stop
+
+        if not noloop:
+            # Check for loop points embedded in wav file, and specify them in multisample xml as bitwig wont load them from wav automatically
+            if not newsample.get('loopstart',None) and not newsample.get('loopstop',None):
+                if wavinfo.loops and start <= wavinfo.loops[0][0] < wavinfo.loops[0][1] <= stop:
+                    newsample['loopmode'] = 'sustain'
+                    newsample['loopstart'] = wavinfo.loops[0][0]
+                    newsample['loopstop'] = wavinfo.loops[0][1]
+                    self.emit('info', 'loop-extracted', "Extracted loop point ({},{}) from {}".format(newsample['loopstart'],newsample['loopstop'],newsample['file']),
+                              file=newsample['file'], loopstart=newsample['loopstart'], loopstop=newsample['loopstop'])
+
+        if 'root' not in newsample and newsample.get('track','true') == 'true':
+            self.emit('error', 'root-missing', "ERROR: No pitch_keycenter for sample {}, root of sample will need to be manually adjusted in Bitwig".format(newsample['file']), file=newsample['file'])
+            newsample['root'] = 0 # bitwig defaults to c4 when root is not given, make the issue more obvious with a more extreme value
+
+        if self.sliceregions and (start > 0 or stop < wavinfo.framecount):
+            self.slicesample(newsample)
+
+        if (newsample['filepath'], newsample['frames']) in self.sampleids:
+            self.emit('warning', 'sample-duplicate', "WARNING: Skipping duplicate sample: {} ({})".format(os.path.basename(newsample.get('file','')),newsample.get('filepath','')), file=newsample.get('file',''), filepath=newsample.get('filepath',''))
+
+        elif 'trigger' in newsample:
+            # bitwig multisample only supports note-on events
+            self.emit('warning', 'sample-trigger', "WARNING: Skipping sample with unhandled trigger event: trigger={}".format(newsample['trigger']), file=newsample.get('file',''), trigger=newsample['trigger'])
 
+        else:
+            self.sampleids.add((newsample['filepath'], newsample['frames']))
+            self.assignarcname(newsample)
+            self.samples.append(newsample)
+            #print("Converted sample {}".format(newsample['file']))
+
+    def slicesample(self, sample):
+        """Make sample refer to a wav holding only its frame range, moving its loop into the range."""
+        start, stop = sample['frames']
+        sample['slice'] = (start, stop)
+        sample['sample-start'] = '0.000'
+        sample['sample-stop'] = stop - start
+
+        if 'loopstart' in sample or 'loopstop' in sample:
+            loopstart = min(max(int(float(sample.get('loopstart', start))) - start, 0), stop - start)
+            loopstop = min(max(int(float(sample.get('loopstop', stop))) - start, 0), stop - start)
+            if loopstart < loopstop:
+                sample['loopstart'] = loopstart
+                sample['loopstop'] = loopstop
+            else:
+                sample.pop('loopstart', None)
+                sample.pop('loopstop', None)
+                sample.pop('loopmode', None)
+
+    def assignarcname(self, sample):
+        """Give sample a unique name inside the multisample, samples with the same content and frames share one entry."""
+        key = (self.contentids.get(sample['filepath'], sample['filepath']), sample.get('slice'))
+        name = self.entrynames.get(key)
+        if name is None:
+            name = self.arcname(sample)
+            root, ext = os.path.splitext(name)
+            n = 1
+            while name in self.entrykeys:
+                # A different wav with the same file name, e.g. from another directory
+                n += 1
+                name = "{}_{}{}".format(root, n, ext)
+            self.entrynames[key] = name
+            self.entrykeys[name] = key
+        sample['arcname'] = name
+
+    def identifysamples(self, paths, threads=1):
+        """Map each path to the content digest of the file when another path has the same size, else to itself."""
+        bysize = defaultdict(list)
+        for path in OrderedDict.fromkeys(paths):
+            try:
+                bysize[os.path.getsize(path)].append(path)
+            except OSError:
+                pass
+        candidates = [path for group in bysize.values() if len(group) > 1 for path in group]
 
+        if threads <= 1 or len(candidates) <= 1:
+            digests = [filedigest(path) for path in candidates]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                digests = list(executor.map(filedigest, candidates))
+
+        return dict(zip(candidates, digests))
+
+    def arcname(self, sample):
+        """Name of the sample file inside the multisample."""
+        if 'arcname' in sample:
+            return sample['arcname']
+        name = os.path.basename(sample.get('file',''))
+        if 'slice' in sample:
+            root, ext = os.path.splitext(name)
+            name = "{}_{}-{}{}".format(root, sample['slice'][0], sample['slice'][1], ext)
+        return name
+
+    def probesamples(self, paths, threads=1):
+        """Read the wav info of each distinct path, using a pool of threads when threads > 1.
+
+        Returns a dict of path to WavInfo, or to the exception raised while reading it so the caller can report it in order.
+        """
+        def probe(path):
+            try:
+                return self.readwavinfo(path)
+            except Exception as e:
+                return e
+
+        paths = list(OrderedDict.fromkeys(paths))
+        if threads <= 1 or len(paths) <= 1:
+            return {path: probe(path) for path in paths}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            return dict(zip(paths, executor.map(probe, paths)))
 
     def makexml(self):
-        xml = ''
-        xml += '<?xml version="1.0" encoding="UTF-8"?>\n'
-        xml += '<multisample name="{}">\n'.format(self.name)
-        xml += '   <generator>Bitwig Studio</generator>\n'
+        xml = io.StringIO()
+        self.writexml(xml)
+
+        return xml.getvalue()
+
+    def writexml(self, out):
+        """Write multisample.xml to the text stream out, element by element."""
+        write = out.write
+        write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        write('<multisample name="{}">\n'.format(xmlescape(self.name)))
+        write('   <generator>Bitwig Studio</generator>\n')
 
         if self.category:
-            xml += '   <category>{}</category>\n'.format(self.category)
+            write('   <category>{}</category>\n'.format(xmlescape(self.category)))
         else:
-            xml += '   <category/>\n'
+            write('   <category/>\n')
         if self.creator:
-            xml += '   <creator>{}</creator>\n'.format(self.creator)
+            write('   <creator>{}</creator>\n'.format(xmlescape(self.creator)))
         else:
-            xml += '   <creator/>\n'
+            write('   <creator/>\n')
         if self.description:
-            xml += '   <description>{}</description>\n'.format(self.description)
+            write('   <description>{}</description>\n'.format(xmlescape(self.description)))
         else:
-            xml += '   <description/>\n'
+            write('   <description/>\n')
 
         if self.keywords:
-            xml += '   <keywords>\n'
+            write('   <keywords>\n')
             for keyword in self.keywords:
-                xml += '      <keyword>{}</keyword>\n'.format(keyword)
-            xml += '   </keywords>\n'
+                write('      <keyword>{}</keyword>\n'.format(xmlescape(keyword)))
+            write('   </keywords>\n')
         else:
-            xml += '   <keywords/>\n'
+            write('   <keywords/>\n')
 
 
-        xml += '   <layer name="Default">\n'
+        write('   <layer name="Default">\n')
 
         for sample in self.samples:
             zonelogic = 'round-robin' if sample.get('playlogic') == "conditional" else 'always-play'
-            xml += '      <sample file="{}" gain="{}" sample-start="{}" sample-stop="{}" zone-logic="{}">\n'.format(os.path.basename(sample.get('file','')),sample.get('gain','0.00'),sample.get('sample-start','0.000'),sample.get('sample-stop','0.000'),zonelogic)
-            xml += '         <key high="{}" low="{}" root="{}" track="{}" tune="{}"/>\n'.format(sample.get('keyhigh',''),sample.get('keylow',''),sample.get('root',''),sample.get('track','true'),sample.get('tune','0.0'))
+            write('      <sample file="{}" gain="{}" sample-start="{}" sample-stop="{}" zone-logic="{}">\n'.format(xmlescape(self.arcname(sample)),xmlescape(sample.get('gain','0.00')),sample.get('sample-start','0.000'),sample.get('sample-stop','0.000'),zonelogic))
+            write('         <key high="{}" low="{}" root="{}" track="{}" tune="{}"/>\n'.format(xmlescape(sample.get('keyhigh','')),xmlescape(sample.get('keylow','')),xmlescape(sample.get('root','')),xmlescape(sample.get('track','true')),sample.get('tune','0.0')))
             vhigh = int(sample.get('velocityhigh','127'))
             vlow = int(sample.get('velocitylow','0'))
             if vhigh == 127 and vlow == 0:
-                xml += '         <velocity/>\n'
+                write('         <velocity/>\n')
             elif vlow == 0:
-                xml += '         <velocity high="{}"/>\n'.format(vhigh)
+                write('         <velocity high="{}"/>\n'.format(vhigh))
             elif vhigh == 127:
-                xml += '         <velocity low="{}"/>\n'.format(vlow)
+                write('         <velocity low="{}"/>\n'.format(vlow))
             else:
-                xml += '         <velocity high="{}" low="{}"/>\n'.format(vhigh,vlow)
-
-            xml += '         <loop mode="{}" start="{}" stop="{}"/>\n'.format(sample.get('loopmode','off'),sample.get('loopstart','0.000'),sample.get('loopstop',sample.get('sample-stop','0.000')))
-            xml += '      </sample>\n'
+                write('         <velocity high="{}" low="{}"/>\n'.format(vhigh,vlow))
 
-        xml += '    </layer>\n'
-        xml += '</multisample>\n'
+            write('         <loop mode="{}" start="{}" stop="{}"/>\n'.format(sample.get('loopmode','off'),xmlescape(sample.get('loopstart','0.000')),xmlescape(sample.get('loopstop',sample.get('sample-stop','0.000')))))
+            write('      </sample>\n')
 
-        return xml
+        write('    </layer>\n')
+        write('</multisample>\n')
 
+    def writexmlentry(self, zf):
+        """Stream multisample.xml into zip zf."""
+        zinfo = zipfile.ZipInfo('multisample.xml', time.localtime(time.time())[:6])
+        zinfo.compress_type = zf.compression
+        zinfo.external_attr = 0o600 << 16                                   # same as ZipFile.writestr
+        with self.stats.phase('xml'), zf.open(zinfo, mode='w') as entry, io.TextIOWrapper(entry, encoding='utf-8', newline='') as out:
+            self.writexml(out)
 
-    def write(self, outpath=None):
-        xml = self.makexml()
 
+    def write(self, outpath=None, incremental=False, options=None, threads=1, inflight=None):
+        """Write the multisample to outpath, a path or a writable binary file object. Defaults to a file named after the multisample."""
         if not outpath:
             outpath = "{}.multisample".format(self.name)
 
-        print("\nWriting multisample {}".format(outpath))
+        with self.stats.phase('zip'):
+            if hasattr(outpath, 'write'):
+                self.writezip(outpath, getattr(outpath, 'name', '<stream>'), threads=threads, inflight=inflight)
+            else:
+                self.writezip(outpath, outpath, incremental, options, threads, inflight)
+
+    def writezip(self, out, outpath, incremental=False, options=None, threads=1, inflight=None):
+        """Write the multisample zip to out, a path or a file object. outpath names it in messages, and is only used
+        as a file when out is the same path."""
+        isfile = out is outpath
+
+        if incremental:
+            manifest = self.makemanifest(options)
+            oldmanifest = readmanifest(outpath)
+            if oldmanifest and os.path.exists(outpath) and oldmanifest.get('entries') == manifest['entries'] and oldmanifest.get('compression') == manifest['compression']:
+                if oldmanifest.get('xml') == manifest['xml']:
+                    self.emit('info', 'up-to-date', "\nMultisample {} is up to date".format(outpath), outpath=outpath)
+                else:
+                    self.emit('info', 'updating-xml', "\nUpdating multisample.xml of {}".format(outpath), outpath=outpath)
+                    self.patchxml(outpath)
+                writemanifest(outpath, manifest)
+                return
+
+        self.emit('info', 'writing', "\nWriting multisample {}".format(outpath), outpath=outpath)
+
+        # Files are written under a temporary name and renamed once complete, an interrupted conversion leaves the previous
+        # multisample (if any) in place. Its entries can still be copied into the new one meanwhile.
+        if isfile:
+            out = "{}.tmp".format(outpath)
+        completed = False
 
         # Build zip containing multisample.xml and sample files
-        zf = zipfile.ZipFile(outpath,mode='w',compression=zipfile.ZIP_DEFLATED)
+        zf = zipfile.ZipFile(out,mode='w',compression=zipfile.ZIP_DEFLATED)
         try:
             #print("Adding multisample.xml")
-            zf.writestr('multisample.xml',xml)
-            for sample in self.samples:
-                #print("Adding sample: {} ({})".format(os.path.basename(sample.get('file','')),sample.get('filepath','')))
-                zf.write(sample.get('filepath',''),os.path.basename(sample.get('file','')))
+            self.writexmlentry(zf)
+            stats = self.compressionstats = CompressionStats()
+            start = time.perf_counter()
+            written = []
+
+            # Regions slicing the same wav share its entry, unless each slice is written separately
+            samples = list(OrderedDict((self.arcname(sample), sample) for sample in reversed(self.samples)).values())[::-1]
+
+            if threads <= 1:
+                for sample in samples:
+                    written.append(self.writeentry(zf, stats, sample, self.compresssample(sample, out if isfile else None)))
+            else:
+                # Samples are read and compressed by the pool, this thread appends them to the zip in order. At most
+                # inflight compressed samples are held in memory.
+                inflight = max(inflight or 2 * threads, 1)
+                with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                    pending = deque()
+                    for sample in samples:
+                        pending.append((sample, executor.submit(self.compresssample, sample, out if isfile else None)))
+                        if len(pending) >= inflight:
+                            sample, future = pending.popleft()
+                            written.append(self.writeentry(zf, stats, sample, future.result()))
+                    while pending:
+                        sample, future = pending.popleft()
+                        written.append(self.writeentry(zf, stats, sample, future.result()))
+
+            stats.wallseconds = time.perf_counter() - start
+            completed = True
 
         finally:
-            zf.close
-            print("Finished writing multisample {}".format(outpath))
+            zf.close()
+            if isfile:
+                if completed:
+                    os.replace(out, outpath)
+                else:
+                    removefile(out)
+            self.emit('info', 'written', "Finished writing multisample {}".format(outpath), outpath=outpath)
+
+        if self.stats.enabled and isfile:
+            self.stats.count(files=1, written=os.path.getsize(outpath))
+
+        if self.entrystore is not None and isfile:
+            zipfingerprint = fingerprint(outpath)
+            for key, zinfo in written:
+                self.entrystore[key] = (os.path.abspath(outpath), zipfingerprint, zinfo)
+
+        self.emit('info', 'compression', stats.summary(), **stats.report())
+
+        if incremental:
+            writemanifest(outpath, manifest)
+
+    def compresssample(self, sample, outpath=None):
+        #print("Adding sample: {} ({})".format(os.path.basename(sample.get('file','')),sample.get('filepath','')))
+        filepath = sample.get('filepath','')
+
+        # Raw copy the entry when an earlier multisample of this batch already compressed the same sample
+        if self.entrystore is not None:
+            stored = self.entrystore.get(self.entrykey(sample))
+            if stored and stored[0] != os.path.abspath(outpath or '') and fingerprint(stored[0]) == stored[1]:
+                zinfo = copy.copy(stored[2])
+                zinfo.filename = zinfo.orig_filename = self.arcname(sample)
+                return zinfo, ZipRawEntry(stored[0], stored[2], self.stats), 0.0
+
+        wavinfo = self.readwavinfo(filepath) if self.compression.mode == 'auto' or 'slice' in sample else None
+        compress_type = self.compression.choose(filepath, wavinfo, sample.get('slice'), self.stats)
+        if 'slice' in sample:
+            source = WavSlice(filepath, wavinfo, sample['slice'], stats=self.stats)
+        else:
+            source = FileChunks(filepath, stats=self.stats)
+        return compressentry(filepath, self.arcname(sample), compress_type, self.compression.level, source)
+
+    def writeentry(self, zf, stats, sample, entry):
+        # The bytes read are counted by the chunk iterables, seconds adds the time of writing the entry to compressing it
+        zinfo, chunks, seconds = entry
+        reused = isinstance(chunks, ZipRawEntry)
+        start = time.perf_counter()
+        if zinfo.compress_type == zipfile.ZIP_STORED and not reused:
+            zinfo = zipwritestream(zf, zinfo, chunks)
+        else:
+            zinfo = zipwriteraw(zf, zinfo, chunks)
+        stats.add(zinfo, seconds + time.perf_counter() - start, reused)
+        return self.entrykey(sample), zinfo
+
+    def entrykey(self, sample):
+        filepath = os.path.abspath(sample.get('filepath',''))
+        return (filepath, tuple(fingerprint(filepath)), sample.get('slice'), self.compression.mode, self.compression.level)
+
+    def patchxml(self, outpath):
+        """Replace multisample.xml of an existing multisample, raw copying the already compressed sample entries."""
+        tmppath = outpath + '.tmp'
+        try:
+            with zipfile.ZipFile(outpath) as oldzf, zipfile.ZipFile(tmppath,mode='w',compression=zipfile.ZIP_DEFLATED) as zf:
+                self.writexmlentry(zf)
+                for info in oldzf.infolist():
+                    if info.filename != 'multisample.xml':
+                        zipwriteraw(zf, info, zipreadraw(oldzf.fp, info))
+                        self.stats.count(read=info.compress_size)
+        except BaseException:
+            removefile(tmppath)
+            raise
+        os.replace(tmppath, outpath)
+        if self.stats.enabled:
+            self.stats.count(files=2, written=os.path.getsize(outpath))
+
+    def makemanifest(self, options=None):
+        """Build manifest describing every input of the multisample, used by incremental builds to detect changes."""
+        entries = {}
+        inputs = {os.path.abspath(path): fingerprint(path) for path in self.sourcefiles}
+        # Missing includes are inputs too, the multisample is out of date once they appear
+        inputs.update((path, None) for path in self.missingincludes)
+        for sample in self.samples:
+            filepath = os.path.abspath(sample.get('filepath',''))
+            inputs[filepath] = fingerprint(filepath)
+            entries.setdefault(self.arcname(sample), [filepath] + inputs[filepath])
+
+        with self.stats.phase('xml'):
+            xml = hashlib.sha1(self.makexml().encode('utf-8')).hexdigest()
+
+        return {
+            'version': 1,
+            'options': options or {},
+            'inputs': inputs,
+            'entries': entries,
+            'compression': [self.compression.mode, self.compression.level],
+            'xml': xml,
+        }
+
+    def emit(self, level, kind, message, **details):
+        self.events(ConversionEvent(level, kind, message, details))
 
     def getbestahdsr(self, histogram):
         ahdsr = { 'attack':[None,0], 'hold':[None,0], 'decay':[None,0], 'sustain':[None,0], 'release':[None,0]  }
@@ -310,165 +955,949 @@ class Multisample(object):
 
         return ahdsr
 
-    def getsamplecount(self, path):
-        ifile = wave.open(path)
-        sampcount = ifile.getnframes()
+    def readwavinfo(self, path):
+        if self.cache:
+            return self.cache.readwavinfo(path)
+        return readwavinfo(path)
 
-        return sampcount
+    def getsamplecount(self, path):
+        return self.readwavinfo(path).framecount
 
-    # based on https://gist.github.com/josephernest/3f22c5ed5dabf1815f16efa8fa53d476
     def readwavmetadata(self, file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False, readloops=False, readpitch=False):
-        if hasattr(file,'read'):
-            fid = file
+        info = readwavinfo(file) if hasattr(file,'read') else self.readwavinfo(file)
+
+        return (([m['position'] for m in info.markers],) if readmarkers else ()) \
+            + (([m['label'] for m in info.markers],) if readmarkerlabels else ()) \
+            + ((info.markers,) if readmarkerslist else ()) \
+            + ((info.loops,) if readloops else ()) \
+            + ((info.pitch,) if readpitch else ())
+
+    def remove_comment(self, line):
+        return re.sub(r"//.*?$", "", line)
+
+    def sfz_note_to_midi_key(self, sfz_note):
+        return sfz_note_to_midi_key(sfz_note)
+
+
+SFZ_NOTE_LETTER_OFFSET = {'a': 9, 'b': 11, 'c': 0, 'd': 2, 'e': 4, 'f': 5, 'g': 7}
+
+@functools.lru_cache(maxsize=None)
+def sfz_note_to_midi_key(sfz_note):
+    sfz_note = re.sub(r"//.*?$", "", sfz_note).strip()
+
+    letter = sfz_note[0].lower()
+    if letter not in SFZ_NOTE_LETTER_OFFSET:
+        return sfz_note
+
+    sharp = '#' in sfz_note
+    octave = int(sfz_note[-1])
+
+    # Notes in bitwig multisample are an octave off (i.e. c4=60, not c3=60)
+    return SFZ_NOTE_LETTER_OFFSET[letter] + ((octave + 2) * 12) + (1 if sharp else 0)
+
+
+def sfz_sample_path(v):
+    path = os.path.normpath(v.replace('\\','/'))
+    if path[0] == '/': # relative path should not contain leading slash
+        path = path[1:]
+    return (('file', path),)
+
+
+# Maps each supported sfz opcode to a function converting its value into (field, value) pairs of a multisample sample
+SFZ_OPCODE_FIELDS = {
+    'sample':           sfz_sample_path,
+    'lokey':            lambda v: (('keylow', sfz_note_to_midi_key(v)),),
+    'hikey':            lambda v: (('keyhigh', sfz_note_to_midi_key(v)),),
+    'pitch_keycenter':  lambda v: (('root', sfz_note_to_midi_key(v)),),
+    'key':              lambda v: (('keylow', sfz_note_to_midi_key(v)), ('keyhigh', sfz_note_to_midi_key(v)), ('root', sfz_note_to_midi_key(v))),
+    'pitch_keytrack':   lambda v: (('track', v),),
+    'lovel':            lambda v: (('velocitylow', v),),
+    'hivel':            lambda v: (('velocityhigh', v),),
+    'volume':           lambda v: (('gain', v),),
+    'tune':             lambda v: (('tune', int(v) * 0.01),),
+    'loop_mode':        lambda v: (('loopmode', 'sustain'),) if v != 'one_shot' else (), # bitwig currently supports off or sustain
+    'loop_start':       lambda v: (('loopstart', v),),
+    'loop_end':         lambda v: (('loopstop', v),),
+    'trigger':          lambda v: (('trigger', v),),
+    'lorand':           lambda v: (('playlogic', 'conditional'),) if float(v) > 0.0 else (),
+    'hirand':           lambda v: (('playlogic', 'conditional'),) if float(v) < 1.0 else (),
+    'seq_length':       lambda v: (('playlogic', 'conditional'),) if int(v) > 1 else (),
+    'offset':           lambda v: (('offset', int(v)),),
+    'end':              lambda v: (('end', int(v)),),
+}
+
+
+class RegionCompiler(object):
+    """Compiles the opcodes of sfz regions into multisample sample fields, with priority global < group < region.
+
+    The opcodes inherited from <global> and <group> are merged and compiled once per header instead of once per region,
+    and the fields of each distinct opcode=value pair are memoized. Ignored opcodes are tallied per distinct combination
+    and only expanded into a histogram by ignored().
+    """
+    def __init__(self):
+        self.global_opcodes = {}
+        self.group_opcodes = {}
+        self.layer = None
+        self.memo = {}
+        self.ignoredcounts = defaultdict(int)
+
+    def setglobal(self, opcodes):
+        self.global_opcodes = opcodes
+        self.layer = None
+
+    def setgroup(self, opcodes):
+        self.group_opcodes = opcodes
+        self.layer = None
+
+    def ignore(self, opcodes):
+        if opcodes:
+            self.ignoredcounts[tuple(opcodes.items())] += 1
+
+    def compile(self, opcodes):
+        if self.layer is None:
+            layeropcodes = dict(ChainMap(self.group_opcodes, self.global_opcodes))
+            layerfields = {}
+            self.layer = (layeropcodes, layerfields, tuple(self.apply(layerfields, layeropcodes.items())))
+        layeropcodes, layerfields, layerignored = self.layer
+
+        if layeropcodes.keys().isdisjoint(opcodes):
+            fields = dict(layerfields)
+            ignored = self.apply(fields, opcodes.items())
+            if layerignored:
+                self.ignoredcounts[layerignored] += 1
         else:
-            fid = open(file, 'rb')
-
-        def _read_riff_chunk(fid):
-            str1 = fid.read(4)
-            if str1 != b'RIFF':
-                raise ValueError("Not a WAV file.")
-            fsize = struct.unpack('<I', fid.read(4))[0] + 8
-            str2 = fid.read(4)
-            if (str2 != b'WAVE'):
-                raise ValueError("Not a WAV file.")
-            return fsize
-        fsize = _read_riff_chunk(fid)
-
-        noc = 1
-        bits = 8
-        #_cue = []
-        #_cuelabels = []
-        _markersdict = defaultdict(lambda: {'position': -1, 'label': ''})
+            # Region overrides inherited opcodes, compile the merged view so opcodes are applied in the same order
+            fields = {}
+            ignored = self.apply(fields, ChainMap(opcodes, layeropcodes).items())
+
+        if ignored:
+            self.ignoredcounts[tuple(ignored)] += 1
+
+        return fields
+
+    def apply(self, fields, items):
+        """Update fields from (opcode, value) items, returning the items that have no multisample equivalent."""
+        memo = self.memo
+        ignored = []
+        for item in items:
+            try:
+                updates = memo[item]
+            except KeyError:
+                convert = SFZ_OPCODE_FIELDS.get(item[0])
+                updates = memo[item] = convert(item[1]) if convert else None
+
+            if updates is None:
+                ignored.append(item)
+            else:
+                fields.update(updates)
+
+        return ignored
+
+    def ignored(self):
+        histogram = defaultdict(int)
+        for items, count in self.ignoredcounts.items():
+            for item in items:
+                histogram[item] += count
+
+        return histogram
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+WAVE_FORMATS_SUPPORTED = (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT, WAVE_FORMAT_EXTENSIBLE)
+
+# fmtchunk and datachunk are [offset, size] of the chunk bodies
+WavInfo = namedtuple('WavInfo', ['framecount', 'loops', 'markers', 'pitch', 'blockalign', 'fmtchunk', 'datachunk'])
+
+# Chunk parsing based on https://gist.github.com/josephernest/3f22c5ed5dabf1815f16efa8fa53d476
+def readwavinfo(file):
+    """Index the chunks of a RIFF/WAVE file in a single pass and return its frame count, smpl loops, cue markers and root pitch.
+
+    Only chunk headers and the small metadata chunks are read, the bodies of data and unknown chunks are skipped over by
+    their declared size, so the cost does not depend on the length of the audio.
+    """
+    if hasattr(file,'read'):
+        fid = file
+    else:
+        fid = open(file, 'rb')
+
+    try:
+        header = fid.read(12)
+        if len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'WAVE':
+            raise ValueError("Not a WAV file.")
+        riffend = struct.unpack('<I', header[4:8])[0] + 8
+
+        blockalign = None
+        fmtchunk = None
+        datachunk = None
+        markers = defaultdict(lambda: {'position': -1, 'label': ''})
         loops = []
         pitch = 0.0
-        while (fid.tell() < fsize):
-            # read the next chunk
-            chunk_id = fid.read(4)
+
+        pos = 12
+        while pos + 8 <= riffend:
+            fid.seek(pos)
+            chunkheader = fid.read(8)
+            if len(chunkheader) < 8:
+                break
+            chunk_id, size = struct.unpack('<4sI', chunkheader)
+
             if chunk_id == b'fmt ':
-                pass
+                fmtchunk = [pos + 8, size]
+                body = fid.read(min(size, 40))
+                if len(body) >= 14:
+                    formattag = struct.unpack('<H', body[0:2])[0]
+                    if formattag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                        formattag = struct.unpack('<H', body[24:26])[0]     # first two bytes of the SubFormat GUID
+                    if formattag not in WAVE_FORMATS_SUPPORTED:
+                        # Block compressed formats (e.g. ADPCM) hold many frames per block, their frame count cannot be
+                        # derived from the size of the data chunk
+                        raise ValueError("Unsupported WAV format 0x{:04x}, only PCM and IEEE float samples are supported.".format(formattag))
+                    blockalign = struct.unpack('<H', body[12:14])[0]
             elif chunk_id == b'data':
-                pass
+                datachunk = [pos + 8, size]
             elif chunk_id == b'cue ':
-                str1 = fid.read(8)
-                size, numcue = struct.unpack('<ii',str1)
-                for c in range(numcue):
-                    str1 = fid.read(24)
-                    id, position, datachunkid, chunkstart, blockstart, sampleoffset = struct.unpack('<iiiiii', str1)
-                    #_cue.append(position)
-                    _markersdict[id]['position'] = position                    # needed to match labels and markers
-
+                body = fid.read(size)
+                numcue = struct.unpack('<i', body[0:4])[0]
+                for c in range(min(numcue, (len(body) - 4) // 24)):
+                    id, position, datachunkid, chunkstart, blockstart, sampleoffset = struct.unpack_from('<iiiiii', body, 4 + c*24)
+                    markers[id]['position'] = position                  # needed to match labels and markers
             elif chunk_id == b'LIST':
-                str1 = fid.read(8)
-                size, type = struct.unpack('<ii', str1)
-            elif chunk_id in [b'ICRD', b'IENG', b'ISFT', b'ISTJ']:    # see http://www.pjb.com.au/midi/sfspec21.html#i5
-                pass
-            elif chunk_id == b'labl':
-                str1 = fid.read(8)
-                size, id = struct.unpack('<ii',str1)
-                size = size + (size % 2)                              # the size should be even, see WAV specfication, e.g. 16=>16, 23=>24
-                label = fid.read(size-4).rstrip(b'\x00')               # remove the trailing null characters
-                #_cuelabels.append(label)
-                _markersdict[id]['label'] = label                           # needed to match labels and markers
-
+                body = fid.read(size)
+                if body[0:4] == b'adtl':
+                    subpos = 4
+                    while subpos + 8 <= len(body):
+                        subchunk_id, subsize = struct.unpack_from('<4sI', body, subpos)
+                        if subchunk_id == b'labl' and subsize >= 4:
+                            id = struct.unpack_from('<i', body, subpos + 8)[0]
+                            label = body[subpos+12:subpos+8+subsize].rstrip(b'\x00')      # remove the trailing null characters
+                            markers[id]['label'] = label.decode('utf-8', 'replace')
+                        subpos += 8 + subsize + (subsize % 2)           # chunks are word aligned, see WAV specification
             elif chunk_id == b'smpl':
-                str1 = fid.read(40)
-                size, manuf, prod, sampleperiod, midiunitynote, midipitchfraction, smptefmt, smpteoffs, numsampleloops, samplerdata = struct.unpack('<iiiiiIiiii', str1)
-                cents = midipitchfraction * 1./(2**32-1)
-                pitch = 440. * 2 ** ((midiunitynote + cents - 69.)/12)
-                for i in range(numsampleloops):
-                    str1 = fid.read(24)
-                    cuepointid, type, start, end, fraction, playcount = struct.unpack('<iiiiii', str1)
-                    loops.append([start, end])
-            else:
-                pass
+                body = fid.read(size)
+                if len(body) >= 36:
+                    manuf, prod, sampleperiod, midiunitynote, midipitchfraction, smptefmt, smpteoffs, numsampleloops, samplerdata = struct.unpack_from('<iiiiIiiii', body)
+                    cents = midipitchfraction * 1./(2**32-1)
+                    pitch = 440. * 2 ** ((midiunitynote + cents - 69.)/12)
+                    for i in range(min(numsampleloops, (len(body) - 36) // 24)):
+                        cuepointid, type, start, end, fraction, playcount = struct.unpack_from('<iiiiii', body, 36 + i*24)
+                        loops.append([start, end])
+
+            pos += 8 + size + (size % 2)                                # chunks are word aligned, see WAV specification
+    finally:
         fid.close()
 
-        _markerslist = sorted([_markersdict[l] for l in _markersdict], key=lambda k: k['position'])  # sort by position
-        _cue = [m['position'] for m in _markerslist]
-        _cuelabels = [m['label'] for m in _markerslist]
+    if datachunk is None or not blockalign:
+        raise ValueError("WAV file has no fmt or data chunk.")
+
+    markerslist = sorted(markers.values(), key=lambda k: k['position'])  # sort by position
+
+    return WavInfo(datachunk[1] // blockalign, loops, markerslist, pitch, blockalign, fmtchunk, datachunk)
+
+
+def xmlescape(value):
+    """Escape value for use as xml text or a double quoted attribute, non string values are formatted as is."""
+    return escape(value, XML_ATTRIBUTE_ENTITIES) if isinstance(value, str) else value
+
+XML_ATTRIBUTE_ENTITIES = {'"': '&quot;'}
+
+
+class CompressionPolicy(object):
+    """Decides whether each sample is deflated or stored in the multisample zip.
+
+    mode 'auto' deflates a probe from the middle of the sample data and stores the sample uncompressed when the probe shrinks
+    by less than AUTO_MIN_SAVING, as 24 bit recordings often barely compress.
+    """
+    PROBE_SIZE = 256 * 1024
+    AUTO_MIN_SAVING = 0.1
+
+    def __init__(self, mode='deflate', level=None):
+        if mode not in ('store', 'deflate', 'auto'):
+            raise ValueError("Unknown compression mode {}".format(mode))
+        self.mode = mode
+        self.level = level
+
+    def choose(self, path, wavinfo=None, frames=None, stats=None):
+        """Compression type for the wav at path. With auto the probe is taken from the middle of its data chunk, or of
+        frames (start, stop) of it, rather than the header and the quiet onset of the recording. The probe read is
+        counted in stats."""
+        if self.mode == 'store':
+            return zipfile.ZIP_STORED
+        if self.mode == 'deflate':
+            return zipfile.ZIP_DEFLATED
+
+        start, end = 0, self.PROBE_SIZE
+        if wavinfo is not None:
+            start, end = wavinfo.datachunk[0], wavinfo.datachunk[0] + wavinfo.datachunk[1]
+            if frames is not None:
+                start, end = start + frames[0] * wavinfo.blockalign, min(start + frames[1] * wavinfo.blockalign, end)
+            middle = (start + end) // 2
+            start = max(start, middle - self.PROBE_SIZE // 2)
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            probe = f.read(min(self.PROBE_SIZE, max(end - start, 0)))
+        if stats is not None:
+            stats.count(files=1, read=len(probe))
+        if not probe:
+            return zipfile.ZIP_STORED
+        compressor = zlib.compressobj(self.level if self.level is not None else zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        compressed = len(compressor.compress(probe)) + len(compressor.flush())
+        return zipfile.ZIP_DEFLATED if compressed <= len(probe) * (1 - self.AUTO_MIN_SAVING) else zipfile.ZIP_STORED
+
+
+class CompressionStats(object):
+    """Bytes saved versus time spent on the sample entries of one multisample."""
+    def __init__(self):
+        self.deflated = 0
+        self.stored = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+        self.wallseconds = 0.0
+        self.reused = 0
+
+    def add(self, info, seconds, reused=False):
+        if reused:
+            self.reused += 1
+        if info.compress_type == zipfile.ZIP_STORED:
+            self.stored += 1
+        else:
+            self.deflated += 1
+        self.bytes_in += info.file_size
+        self.bytes_out += info.compress_size
+        self.seconds += seconds
+
+    def summary(self):
+        saved = self.bytes_in - self.bytes_out
+        return "  Samples: {} deflated, {} stored, {} reused, {:.1f} MB -> {:.1f} MB ({:.1f} MB / {:.1f}% saved) in {:.2f} s ({:.2f} s wall)".format(
+            self.deflated, self.stored, self.reused, self.bytes_in / 1e6, self.bytes_out / 1e6, saved / 1e6,
+            100.0 * saved / self.bytes_in if self.bytes_in else 0.0, self.seconds, self.wallseconds)
+
+    def report(self):
+        return {'deflated': self.deflated, 'stored': self.stored, 'reused': self.reused, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                'ratio': self.bytes_out / self.bytes_in if self.bytes_in else 1.0, 'seconds': self.seconds, 'wallseconds': self.wallseconds}
+
+
+class ConversionStats(object):
+    """Wall and cpu time spent in each phase of a conversion, and the files it read and wrote.
+
+    Phases may nest, the time of a nested phase is only counted for the nested phase. The cpu time is that of the
+    whole process, so it includes the threads compressing or probing samples.
+    """
+    PHASES = ['parse', 'regions', 'probe', 'xml', 'zip', 'other']
+    enabled = True
+
+    def __init__(self):
+        self.phases = OrderedDict((name, [0.0, 0.0]) for name in self.PHASES)
+        self.files_opened = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.stack = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        frame = [time.perf_counter(), time.process_time(), 0.0, 0.0]        # start wall, start cpu, nested wall, nested cpu
+        self.stack.append(frame)
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - frame[0]
+            cpu = time.process_time() - frame[1]
+            self.stack.pop()
+            totals = self.phases.setdefault(name, [0.0, 0.0])
+            totals[0] += wall - frame[2]
+            totals[1] += cpu - frame[3]
+            if self.stack:
+                self.stack[-1][2] += wall
+                self.stack[-1][3] += cpu
+
+    def iterate(self, name, iterable):
+        """Yield the items of iterable, counting the time spent producing them for phase name."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, files=0, read=0, written=0):
+        # Called from the threads reading samples as well
+        with self.lock:
+            self.files_opened += files
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def report(self, multisample=None, cache=None):
+        report = {
+            'phases': {name: {'wall': wall, 'cpu': cpu} for name, (wall, cpu) in self.phases.items()},
+            'wall': sum(wall for wall, cpu in self.phases.values()),
+            'cpu': sum(cpu for wall, cpu in self.phases.values()),
+            'files_opened': self.files_opened,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+        }
+        if multisample and multisample.compressionstats:
+            report['compression'] = multisample.compressionstats.report()
+        if cache:
+            report['cache'] = {'hits': cache.hits, 'misses': cache.misses}
+        return report
+
+    def printsummary(self):
+        print("  Phases: {}".format(", ".join("{} {:.3f} s ({:.3f} s cpu)".format(name, wall, cpu) for name, (wall, cpu) in self.phases.items())))
+        print("  I/O: {} files opened, {:.1f} MB read, {:.1f} MB written".format(self.files_opened, self.bytes_read / 1e6, self.bytes_written / 1e6))
+
+
+class NullStats(object):
+    """Stands in for ConversionStats when no statistics are wanted, at the cost of a method call per phase."""
+    enabled = False
+
+    def phase(self, name):
+        return NULL_PHASE
+
+    def iterate(self, name, iterable):
+        return iterable
+
+    def count(self, files=0, read=0, written=0):
+        pass
+
+NULL_PHASE = nullcontext()
+NULL_STATS = NullStats()
 
-        return ((_cue,) if readmarkers else ()) \
-            + ((_cuelabels,) if readmarkerlabels else ()) \
-            + ((_markerslist,) if readmarkerslist else ()) \
-            + ((loops,) if readloops else ()) \
-            + ((pitch,) if readpitch else ())
 
-    def remove_comment(self, line):
-        return re.sub(r"//.*?$", "", line)
+def multisampleoutpath(sfzfile):
+    return "{}.multisample".format(os.path.splitext(sfzfile)[0])
 
-    def sfz_note_to_midi_key(self, sfz_note):
-        sfz_note = self.remove_comment(sfz_note).strip()
 
-        SFZ_NOTE_LETTER_OFFSET = {'a': 9, 'b': 11, 'c': 0, 'd': 2, 'e': 4, 'f': 5, 'g': 7}
-        letter = sfz_note[0].lower()
-        if letter not in SFZ_NOTE_LETTER_OFFSET.keys():
-            return sfz_note
+def fingerprint(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
 
-        sharp = '#' in sfz_note
-        octave = int(sfz_note[-1])
 
-        # Notes in bitwig multisample are an octave off (i.e. c4=60, not c3=60)
-        return SFZ_NOTE_LETTER_OFFSET[letter] + ((octave + 2) * 12) + (1 if sharp else 0)
+def manifestpath(outpath):
+    head, tail = os.path.split(outpath)
+    return os.path.join(head, '.{}.manifest'.format(tail))
 
 
-#SFZParser code taken from https://github.com/SpotlightKid/sfzparser/blob/master/sfzparser.py
-class SFZParser(object):
-    rx_section = re.compile('^<([^>]+)>\s?')
+def readmanifest(outpath):
+    try:
+        with open(manifestpath(outpath), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-    def __init__(self, sfz_path, encoding=None, **kwargs):
+
+def writemanifest(outpath, manifest):
+    writejsonfile(manifestpath(outpath), manifest)
+
+
+def writejsonfile(path, data):
+    """Write data to path through a temporary file, so readers never see a partially written file."""
+    tmppath = "{}.tmp".format(path)
+    with open(tmppath, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmppath, path)
+
+
+def removefile(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def isuptodate(outpath, options):
+    """True when outpath was built with options and none of the inputs recorded in its manifest changed since."""
+    manifest = readmanifest(outpath)
+    if not manifest or manifest.get('options') != options or not os.path.exists(outpath):
+        return False
+
+    # A None fingerprint records an input that was missing, e.g. an #include, it changes when the file appears
+    for path, fp in manifest['inputs'].items():
+        if pollfingerprint(path) != fp:
+            return False
+
+    return True
+
+
+def compressentry(path, arcname, compress_type, level=None, source=None):
+    """Read and compress source into a zip entry held in memory, returns (ZipInfo, compressed chunks, seconds spent).
+
+    source is an iterable over the bytes of the entry, such as a WavSlice of path, and defaults to FileChunks(path).
+    Stored entries are not read here, source is streamed into the zip by zipwritestream in a single pass.
+    """
+    start = time.perf_counter()
+    if source is None:
+        source = FileChunks(path)
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    zinfo.compress_type = compress_type
+    if compress_type == zipfile.ZIP_STORED:
+        zinfo.file_size = len(source)
+        return zinfo, source, 0.0
+    compressor = zlib.compressobj(level if level is not None else zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+    chunks = []
+    crc = 0
+    size = 0
+    for block in source:
+        crc = zlib.crc32(block, crc)
+        size += len(block)
+        chunks.append(compressor.compress(block))
+    chunks.append(compressor.flush())
+
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = sum(len(chunk) for chunk in chunks)
+
+    return zinfo, chunks, time.perf_counter() - start
+
+
+class FileChunks(object):
+    """Iterable over the bytes of the file at path, read chunksize bytes at a time when iterated. The reads are counted
+    in stats."""
+    def __init__(self, path, chunksize=1<<20, stats=NULL_STATS):
+        self.path = path
+        self.chunksize = chunksize
+        self.stats = stats
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            self.stats.count(files=1)
+            for block in iter(lambda: f.read(self.chunksize), b''):
+                self.stats.count(read=len(block))
+                yield block
+
+    def __len__(self):
+        return os.path.getsize(self.path)
+
+
+class WavSlice(object):
+    """Iterable over the bytes of a wav file holding frames (start, stop) of another, with a rewritten RIFF header. The
+    bytes copied from the other file are counted in stats."""
+    def __init__(self, path, wavinfo, frames, chunksize=1<<20, stats=NULL_STATS):
+        self.path = path
+        self.wavinfo = wavinfo
+        self.frames = frames
+        self.chunksize = chunksize
+        self.stats = stats
+
+    def layout(self, filesize):
+        """(data offset, data size) of the slice in a file of filesize bytes."""
+        datastart = self.wavinfo.datachunk[0] + self.frames[0] * self.wavinfo.blockalign
+        datasize = (self.frames[1] - self.frames[0]) * self.wavinfo.blockalign
+        return datastart, max(min(datasize, filesize - datastart), 0)
+
+    def __len__(self):
+        fmtsize = self.wavinfo.fmtchunk[1]
+        datasize = self.layout(os.path.getsize(self.path))[1]
+        return 12 + 8 + fmtsize + fmtsize % 2 + 8 + datasize + datasize % 2
+
+    def __iter__(self):
+        fmtoffset, fmtsize = self.wavinfo.fmtchunk
+
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            datastart, datasize = self.layout(len(mm))
+            fmt = mm[fmtoffset:fmtoffset + fmtsize] + b'\x00' * (fmtsize % 2)
+            self.stats.count(files=1, read=fmtsize)
+            riffsize = 4 + 8 + len(fmt) + 8 + datasize + datasize % 2
+            yield b'RIFF' + struct.pack('<I', riffsize) + b'WAVE' + b'fmt ' + struct.pack('<I', fmtsize) + fmt + b'data' + struct.pack('<I', datasize)
+
+            view = memoryview(mm)
+            try:
+                for pos in range(datastart, datastart + datasize, self.chunksize):
+                    block = view[pos:min(pos + self.chunksize, datastart + datasize)]
+                    self.stats.count(read=len(block))
+                    yield block
+                    block.release()
+            finally:
+                view.release()
+
+            if datasize % 2:
+                yield b'\x00'                                             # chunks are word aligned, see WAV specification
+
+
+def zipreadraw(fp, info, chunksize=1<<20):
+    """Yield the compressed bytes of zip entry info, read from the zip file object fp."""
+    fp.seek(info.header_offset)
+    fheader = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+    if fheader[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad magic number for file header of {}".format(info.filename))
+    fp.seek(fheader[10] + fheader[11], 1)                              # skip file name and extra field
+
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = fp.read(min(remaining, chunksize))
+        if not chunk:
+            raise zipfile.BadZipFile("Truncated entry {}".format(info.filename))
+        remaining -= len(chunk)
+        yield chunk
+
+
+def zipwriteraw(zf, info, chunks):
+    """Append an already compressed entry to zf. info must describe chunks (CRC, compress_size, file_size, compress_type)."""
+    zinfo = copy.copy(info)
+    zinfo.flag_bits &= ~0x08                                            # sizes are known up front, no data descriptor
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader())
+    for chunk in chunks:
+        zf.fp.write(chunk)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = zf.fp.tell()
+
+    return zinfo
+
+
+def zipwritestream(zf, info, chunks):
+    """Append the uncompressed chunks to zf as a stored entry, zipfile computes the CRC while they are written.
+    info.file_size must be the total size of chunks."""
+    zinfo = copy.copy(info)
+    with zf.open(zinfo, mode='w') as dest:
+        for chunk in chunks:
+            dest.write(chunk)
+
+    return zinfo
+
+
+class ZipRawEntry(object):
+    """Iterable over the compressed bytes of entry info in the zip file at path, read when iterated. The reads are
+    counted in stats."""
+    def __init__(self, path, info, stats=NULL_STATS):
+        self.path = path
+        self.info = info
+        self.stats = stats
+
+    def __iter__(self):
+        with open(self.path, 'rb') as fp:
+            self.stats.count(files=1)
+            for chunk in zipreadraw(fp, self.info):
+                self.stats.count(read=len(chunk))
+                yield chunk
+
+
+def filedigest(path):
+    """sha1 of the contents of path, memoized by path, size and mtime for the lifetime of the process."""
+    key = (os.path.abspath(path),) + tuple(fingerprint(path))
+    digest = CONTENT_DIGESTS.get(key)
+    if digest is None:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        digest = CONTENT_DIGESTS[key] = sha1.hexdigest()
+    return digest
+
+
+class SampleCache(object):
+    """Persistent wav metadata cache, stored in an sqlite database and keyed by absolute path, size and mtime.
+
+    Lookups and updates are kept in memory and written back in a single transaction by flush() or close(), which also
+    evict the least recently used entries once the cache holds more than maxentries samples.
+    """
+    SCHEMA_VERSION = 3
+
+    def __init__(self, cachedir, maxentries=200000, warn=print):
+        os.makedirs(cachedir, exist_ok=True)
+        self.warn = warn
+        self.path = os.path.join(cachedir, 'wavinfo.sqlite')
+        self.maxentries = maxentries
+        self.entries = {}
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        try:
+            if self.db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                self.db.execute('DROP TABLE IF EXISTS wavinfo')
+                self.db.execute('PRAGMA user_version = {}'.format(self.SCHEMA_VERSION))
+            self.db.execute('CREATE TABLE IF NOT EXISTS wavinfo (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, used REAL, info TEXT)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS wavinfo_used ON wavinfo (used)')
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.close()
+            raise
+
+    def readwavinfo(self, path):
+        """Return the WavInfo of path, safe to call from several threads."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime_ns)
+
+        with self.lock:
+            info = self.entries.get(key)
+            if info is None:
+                row = self.db.execute('SELECT info FROM wavinfo WHERE path=? AND size=? AND mtime=?', key).fetchone()
+                if row:
+                    info = self.entries[key] = WavInfo(*json.loads(row[0]))
+                    self.hits += 1
+
+        if info is None:
+            info = readwavinfo(path)
+            with self.lock:
+                self.entries[key] = info
+                self.misses += 1
+
+        with self.lock:
+            self.used[key] = time.time()
+        return info
+
+    def prune(self, fingerprint):
+        """Forget the entries held in memory whose file no longer has the size and mtime they were read with.
+        fingerprint(path) returns the current [size, mtime] of path, or None."""
+        with self.lock:
+            for key in [key for key in self.entries if fingerprint(key[0]) != list(key[1:])]:
+                del self.entries[key]
+                self.used.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.used.clear()
+        self.db.execute('DELETE FROM wavinfo')
+        self.db.commit()
+
+    def close(self, warn=None):
+        try:
+            self.flush(warn)
+        finally:
+            self.db.close()
+
+    def flush(self, warn=None):
+        """Write the entries used since the cache was opened back to the database. A failure is passed to warn, by
+        default the warn given to the cache."""
+        with self.lock:
+            rows = [key + (used, json.dumps(self.entries[key])) for key, used in self.used.items()]
+        try:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO wavinfo (path, size, mtime, used, info) VALUES (?,?,?,?,?)', rows)
+                count = self.db.execute('SELECT COUNT(*) FROM wavinfo').fetchone()[0]
+                if count > self.maxentries:
+                    self.db.execute('DELETE FROM wavinfo WHERE path IN (SELECT path FROM wavinfo ORDER BY used LIMIT ?)', (count - self.maxentries,))
+        except sqlite3.Error as e:
+            (warn or self.warn)("WARNING: Could not update wav metadata cache {}: {}".format(self.path, e))
+
+
+#SFZParser originally based on https://github.com/SpotlightKid/sfzparser/blob/master/sfzparser.py
+class SFZParser(object):
+    """Streaming sfz parser, iterating over it yields (section name, opcodes) pairs in file order.
+
+    Each line is tokenized in a single pass. An opcode value runs up to the next header, opcode or comment on the same
+    line, so values may contain spaces (e.g. sample=Piano C4 soft.wav).
+
+    #define $VAR substitutions are applied and #include "file" directives are replaced by the contents of the included
+    file, resolved relative to the directory of the sfz file. When a fragment_cache dict is given, the tokens of each
+    included file are kept in it and reused by later parsers, as long as the file is unchanged and the $VARs it
+    references have the same values.
+    """
+    rx_header = re.compile(r'<([^>]+)>')
+    rx_comment = re.compile(r'(?:^|(?<=\s))//')
+    rx_define = re.compile(r'#define\s+(\$\w+)\s+(.*?)\s*$')
+    rx_include = re.compile(r'#include\s+"([^"]+)"')
+    rx_variable = re.compile(r'\$\w+')
+    MAX_INCLUDE_DEPTH = 32
+
+    def __init__(self, sfz_path, encoding=None, defines=None, fragment_cache=None, warn=print, basedir=None, **kwargs):
         self.encoding = encoding
+        self.warn = warn
+        self.source = None
+        if hasattr(sfz_path, 'read'):
+            # Read file objects up front, so the parser can be iterated more than once like a path
+            source = sfz_path.read()
+            self.source = source.decode(encoding or 'utf-8-sig') if isinstance(source, bytes) else source
+            sfz_path = getattr(sfz_path, 'name', None)
+            if not isinstance(sfz_path, str):
+                sfz_path = '<stream>'
+            if basedir is None:
+                basedir = os.getcwd()
         self.sfz_path = sfz_path
-        self.groups = []
-        self.sections = []
-
-        with open(sfz_path, encoding=self.encoding or 'utf-8-sig') as sfz:
-            self.parse(sfz)
-
-    def parse(self, sfz):
-        sections = self.sections
-        cur_section = []
-        value = None
-
-        for line in sfz:
-            line = line.strip()
-
-            if not line:
-                continue
-
-            if line.startswith('//'):
-                sections.append(('comment', line))
-                continue
-
-            while line:
-                match = self.rx_section.search(line)
-                if match:
-                    if cur_section:
-                        sections.append((section_name, OrderedDict(reversed(cur_section))))
-                        cur_section = []
-
-                    section_name = match.group(1).strip()
-                    line = line[match.end():].lstrip()
-                elif "=" in line:
-                    line, _, value = line.rpartition('=')
-                    if '=' in line:
-                        line, key = line.rsplit(None, 1)
-                        cur_section.append((key, value))
-                        value = None
-                elif value:
-                    line, key = None, line
-                    cur_section.append((key, value))
-                else:
-                    if line.startswith('//'):
-                        print("Warning: inline comment")
-                        sections.append(('comment', line))
-                    # ignore garbage
-                    break
+        self.basedir = os.path.abspath(basedir) if basedir is not None else os.path.dirname(os.path.abspath(sfz_path))
+        self.defines = defines or {}
+        self.fragment_cache = fragment_cache
+        self.includes = set()
+        self.missingincludes = set()
+        self.fragment_hits = 0
+        self._frames = []
+
+    def __iter__(self):
+        self.includes = set()
+        self.missingincludes = set()
+        for section in self.parse(self.filetokens(self.sfz_path, dict(self.defines))):
+            yield section
+
+    @property
+    def sections(self):
+        return list(self)
+
+    def parse(self, tokens):
+        section_name = None
+        opcodes = None
+
+        for key, value in tokens:
+            if key == '<':
+                if section_name is not None:
+                    yield section_name, opcodes
+                section_name = value
+                opcodes = OrderedDict()
+            elif opcodes is not None:
+                opcodes[key] = value
+
+        if section_name is not None:
+            yield section_name, opcodes
+
+    def filetokens(self, path, defines, depth=0):
+        """Yield the tokens of path after preprocessing, defines is updated by the #define directives encountered."""
+        if depth == 0 and self.source is not None:
+            sfz = io.StringIO(self.source)
+        else:
+            sfz = open(path, encoding=self.encoding or 'utf-8-sig')
+        with sfz:
+            for line in sfz:
+                if '#' in line:
+                    directive = line.strip()
+                    if directive.startswith('#define'):
+                        match = self.rx_define.match(directive)
+                        if match:
+                            self.define(defines, match.group(1), match.group(2))
+                        continue
+                    elif directive.startswith('#include'):
+                        match = self.rx_include.match(directive)
+                        if match:
+                            for token in self.includetokens(match.group(1), defines, depth + 1):
+                                yield token
+                        continue
+
+                if '$' in line:
+                    line = self.rx_variable.sub(lambda match: self.expand(match.group(0), defines), line)
+
+                for token in self.tokenize(line):
+                    yield token
+
+    def includetokens(self, include, defines, depth):
+        path = os.path.join(self.basedir, os.path.normpath(include.replace('\\','/')))
+        if depth > self.MAX_INCLUDE_DEPTH:
+            raise ValueError("#include nested too deeply in {}".format(path))
+        stat = includestat(path)
+        self.addinclude(path, stat)
+        if stat is None:
+            self.warnmissing("WARNING: Skipping missing #include \"{}\" ({})".format(include, path))
+            return ()
+
+        if self.fragment_cache is not None:
+            for fragment in self.fragment_cache.get(path, ()):
+                if fragment.stat == stat and fragment.basedir == self.basedir and all(defines.get(k) == v for k, v in fragment.used.items()) \
+                        and all(includestat(include) == includedstat for include, includedstat in fragment.includes.items()):
+                    self.fragment_hits += 1
+                    for name in fragment.used:
+                        self.record(name)
+                    for name, value in fragment.assigned.items():
+                        self.define(defines, name, value)
+                    for include, includedstat in fragment.includes.items():
+                        self.addinclude(include, includedstat)
+                    for message in fragment.warnings:
+                        self.warnmissing(message)
+                    return fragment.tokens
+
+        # Track the $VARs read and written and the files included while tokenizing the fragment, they decide when its
+        # tokens can be reused
+        frame = IncludeFragment(stat, self.basedir, dict(defines), {}, {}, {}, [], None)
+        self._frames.append(frame)
+        try:
+            tokens = tuple(self.filetokens(path, defines, depth))
+        finally:
+            self._frames.pop()
+
+        if self.fragment_cache is not None:
+            # Keep the variants made for other $VAR values, drop those made from an older version of the file
+            variants = [fragment for fragment in self.fragment_cache.get(path, ())
+                        if fragment.stat == stat and (fragment.basedir, fragment.used) != (frame.basedir, frame.used)]
+            self.fragment_cache[path] = variants + [frame._replace(tokens=tokens)]
+
+        return tokens
+
+    def addinclude(self, path, stat):
+        """Record that path was included, stat is its (size, mtime) or None when it is missing."""
+        if stat is not None:
+            self.includes.add(path)
+        else:
+            self.missingincludes.add(path)
+        for frame in self._frames:
+            frame.includes[path] = stat
+
+    def warnmissing(self, message):
+        self.warn(message)
+        for frame in self._frames:
+            frame.warnings.append(message)
+
+    def define(self, defines, name, value):
+        defines[name] = value
+        for frame in self._frames:
+            frame.assigned[name] = value
+
+    def record(self, name):
+        for frame in self._frames:
+            if name not in frame.used:
+                frame.used[name] = frame.incoming.get(name)
+
+    def expand(self, variable, defines):
+        # $VAR may be directly followed by other text (e.g. $NAMEsoft.wav), use the longest defined prefix
+        for end in range(len(variable), 1, -1):
+            name = variable[:end]
+            self.record(name)
+            if name in defines:
+                return defines[name] + variable[end:]
+
+        return variable
+
+    def tokenize(self, line):
+        """Return ('<', name) for each section header and (key, value) for each opcode of line."""
+        tokens = []
+
+        if '//' in line:
+            match = self.rx_comment.search(line)
+            if match:
+                line = line[:match.start()]
+
+        # rx_header.split alternates between opcode text and header names
+        parts = self.rx_header.split(line) if '<' in line else (line,)
+        for i, text in enumerate(parts):
+            if i % 2:
+                tokens.append(('<', text.strip()))
+            elif '=' in text:
+                fields = text.split('=')
+                key = fields[0].rsplit(None, 1)
+                key = key[-1] if key else None
+                for field in fields[1:-1]:
+                    words = field.rsplit(None, 1)
+                    if len(words) == 2:
+                        value, nextkey = words[0].strip(), words[1]
+                    else:
+                        value, nextkey = '', (words[0] if words else None)
+                    if key and value:
+                        tokens.append((key, value))
+                    key = nextkey
+                value = fields[-1].strip()
+                if key and value:
+                    tokens.append((key, value))
+
+        return tokens
+
+
+# includes maps the path of every file included by the fragment, directly or not, to its (size, mtime) or None when missing
+IncludeFragment = namedtuple('IncludeFragment', ['stat', 'basedir', 'incoming', 'used', 'assigned', 'includes', 'warnings', 'tokens'])
 
-        if cur_section:
-            sections.append((section_name, OrderedDict(reversed(cur_section))))
 
-        return sections
+def includestat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for sfz2bitwig on synthetic sfz/wav libraries.
+
+Generates libraries of configurable size, times each conversion phase separately and writes the results to a json
+file that can be compared against an earlier run:
+
+    python sfz2bitwig_bench.py --regions 100 1000 10000 --output before.json
+    python sfz2bitwig_bench.py --regions 100 1000 10000 --output after.json --compare before.json
+"""
+
+from contextlib import redirect_stdout
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import struct
+import sys
+import tempfile
+import time
+
+import sfz2bitwig
+
+
+PHASES = ['parse', 'regions', 'probe', 'xml', 'zip']
+
+
+def parse_commandline():
+    parser = argparse.ArgumentParser(prog='sfz2bitwig_bench', description='Time the conversion phases of sfz2bitwig on generated libraries.')
+    parser.add_argument('--regions', default=[100, 1000, 10000], type=int, nargs='+', help='region counts to benchmark (default: %(default)s)')
+    parser.add_argument('--samples', default=64, type=int, help='distinct wav files per library, regions address them with offset/end (default: %(default)s)')
+    parser.add_argument('--frames', default=44100, type=int, help='frames per wav (default: %(default)s)')
+    parser.add_argument('--channels', default=2, type=int, help='channels per wav (default: %(default)s)')
+    parser.add_argument('--bits', default=24, type=int, choices=[16, 24, 32], help='bits per sample (default: %(default)s)')
+    parser.add_argument('--no-smpl', default=False, action='store_true', help='do not add smpl loop chunks to the wavs')
+    parser.add_argument('--no-cue', default=False, action='store_true', help='do not add cue/labl marker chunks to the wavs')
+    parser.add_argument('--groups', default=8, type=int, help='number of <group> sections the regions are spread over (default: %(default)s)')
+    parser.add_argument('--single-line', default=False, action='store_true', help='write all regions of a group on one long line')
+    parser.add_argument('--probe-threads', default=8, type=int, help='threads probing the wavs, as sfz2bitwig --probe-threads (default: %(default)s)')
+    parser.add_argument('--threads', default=0, type=int, help='threads compressing the samples, as sfz2bitwig --threads (default: all cpus)')
+    parser.add_argument('--repeat', default=3, type=int, help='runs per phase, the minimum and median are reported (default: %(default)s)')
+    parser.add_argument('--workdir', default=None, help='directory for the generated libraries (default: a temporary directory, removed afterwards)')
+    parser.add_argument('--output', default='bench.json', help='json file receiving the results (default: %(default)s)')
+    parser.add_argument('--compare', default=None, help='earlier results json to compare against')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_commandline()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sfz2bitwig_bench')
+    try:
+        results = {
+            'version': sfz2bitwig.VERSION,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'params': {k: v for k, v in vars(args).items() if k not in ('workdir', 'output', 'compare')},
+            'scenarios': {},
+        }
+
+        for regions in args.regions:
+            name = 'regions-{}'.format(regions)
+            sfzfile = makelibrary(os.path.join(workdir, name), regions, args)
+            print("{}: {} regions over {} wavs".format(name, regions, min(args.samples, regions)))
+            results['scenarios'][name] = benchmark(sfzfile, args.repeat, args.probe_threads, args.threads or (os.cpu_count() or 1))
+            for phase in PHASES:
+                print("  {:8} {:9.4f} s".format(phase, results['scenarios'][name][phase]['min']))
+
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print("\nWrote results to {}".format(args.output))
+
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as f:
+                printcomparison(json.load(f), results)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return 0
+
+
+def makewav(path, frames, channels, bits, smpl, cue, rnd):
+    blockalign = channels * bits // 8
+    fmt = struct.pack('<HHIIHH', 1, channels, 44100, 44100 * blockalign, blockalign, bits)
+    # Low amplitude noise compresses roughly like real recordings
+    data = bytes(rnd.getrandbits(6) for _ in range(min(frames * blockalign, 1 << 16)))
+    data = (data * (frames * blockalign // len(data) + 1))[:frames * blockalign]
+
+    chunks = [b'fmt ' + struct.pack('<I', len(fmt)) + fmt, b'data' + struct.pack('<I', len(data)) + data + b'\x00' * (len(data) % 2)]
+    if smpl:
+        body = struct.pack('<iiiiIiiii', 0, 0, 22675, 60, 0, 0, 0, 1, 0) + struct.pack('<iiiiii', 0, 0, frames // 4, frames // 2, 0, 0)
+        chunks.append(b'smpl' + struct.pack('<I', len(body)) + body)
+    if cue:
+        body = struct.pack('<i', 1) + struct.pack('<iiiiii', 1, frames // 8, 0x61746164, 0, 0, frames // 8)
+        chunks.append(b'cue ' + struct.pack('<I', len(body)) + body)
+        label = struct.pack('<i', 1) + b'attack\x00\x00'
+        adtl = b'adtl' + b'labl' + struct.pack('<I', len(label)) + label
+        chunks.append(b'LIST' + struct.pack('<I', len(adtl)) + adtl)
+
+    body = b'WAVE' + b''.join(chunks)
+    with open(path, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', len(body)) + body)
+
+
+def makelibrary(root, regions, args):
+    """Write a library of regions regions spread over args.groups groups and args.samples wavs, return the sfz path."""
+    rnd = random.Random(regions)
+    samples = min(args.samples, regions)
+    os.makedirs(os.path.join(root, 'samples'), exist_ok=True)
+    for i in range(samples):
+        makewav(os.path.join(root, 'samples', 'Sample {:04d}.wav'.format(i)), args.frames, args.channels, args.bits, not args.no_smpl, not args.no_cue, rnd)
+
+    # Each wav is cut into enough slices that every region plays a distinct frame range
+    slices = (regions + samples - 1) // samples
+    slicelength = max(args.frames // slices, 1)
+
+    sfzfile = os.path.join(root, 'library.sfz')
+    with open(sfzfile, 'w', encoding='utf-8') as f:
+        f.write('// generated by sfz2bitwig_bench\n<control> default_path=samples/\n')
+        f.write('<global> ampeg_attack=0.001 ampeg_release=0.4 amp_veltrack=100\n')
+        groups = max(args.groups, 1)
+        for g in range(groups):
+            f.write('<group> lovel={} hivel={} seq_length=1 ampeg_decay=1.{}\n'.format(g * 127 // groups, (g + 1) * 127 // groups - 1 if g < groups - 1 else 127, g))
+            separator = ' ' if args.single_line else '\n'
+            lines = []
+            for r in range(g, regions, groups):
+                key = 21 + r % 88
+                lines.append('<region> sample=Sample {:04d}.wav lokey={} hikey={} pitch_keycenter={} offset={} end={} tune={} volume=-{}.5 fil_type=lpf_2p cutoff={}'.format(
+                    r % samples, key, key, key, (r // samples) * slicelength, (r // samples + 1) * slicelength - 1, rnd.randint(-20, 20), rnd.randint(0, 6), rnd.randint(200, 20000)))
+            f.write(separator.join(lines) + '\n')
+
+    return sfzfile
+
+
+def timephase(fn, repeat, measure=None):
+    """Run fn repeat times, the time of a run is its wall time or measure(result) when given."""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(measure(result) if measure else time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'runs': times}, result
+
+
+def benchmark(sfzfile, repeat, probethreads=8, threads=1):
+    """Time each phase of converting sfzfile, with the thread counts of the command line. The wav metadata cache is not
+    used, every probe reads the wav headers."""
+    results = {}
+    quiet = io.StringIO()
+
+    results['parse'], sections = timephase(lambda: list(sfz2bitwig.SFZParser(sfzfile)), repeat)
+
+    def mapregions():
+        regions = sfz2bitwig.RegionCompiler()
+        compiled = []
+        for name, opcodes in sections:
+            if name == 'group':
+                regions.setgroup(opcodes)
+            elif name == 'global':
+                regions.setglobal(opcodes)
+            elif name == 'region':
+                compiled.append(regions.compile(opcodes))
+        return compiled
+    results['regions'], compiled = timephase(mapregions, repeat)
+
+    sampledir = os.path.join(os.path.dirname(sfzfile), 'samples')
+    paths = [os.path.join(sampledir, sample['file']) for sample in compiled]
+    results['probe'], wavinfos = timephase(lambda: sfz2bitwig.Multisample().probesamples(paths, probethreads), repeat)
+
+    multisamp = sfz2bitwig.Multisample()
+    with redirect_stdout(quiet):
+        multisamp.initFromSFZ(sfzfile)
+    results['xml'], xml = timephase(multisamp.makexml, repeat)
+
+    outpath = os.path.join(os.path.dirname(sfzfile), 'library.multisample')
+    # Only the sample entries are timed, multisample.xml is streamed into the zip under its own phase
+    def writezip():
+        multisamp.stats = sfz2bitwig.ConversionStats()
+        with redirect_stdout(quiet):
+            multisamp.write(outpath, threads=threads)
+        return multisamp.stats
+    results['zip'], stats = timephase(writezip, repeat, lambda stats: stats.phases['zip'][0])
+    size = os.path.getsize(outpath)
+
+    results['counts'] = {'sections': len(sections), 'regions': len(compiled), 'samples': len(multisamp.samples),
+                         'wavs': len(wavinfos), 'xml_bytes': len(xml), 'zip_bytes': size}
+    return results
+
+
+def printcomparison(before, after):
+    print("\nCompared to {} ({}):".format(before.get('created', '?'), before.get('version', '?')))
+    for name, phases in after['scenarios'].items():
+        if name not in before.get('scenarios', {}):
+            continue
+        print("  {}".format(name))
+        for phase in PHASES:
+            old = before['scenarios'][name].get(phase, {}).get('min')
+            new = phases[phase]['min']
+            if old:
+                print("    {:8} {:9.4f} s -> {:9.4f} s  ({:+.1f}%)".format(phase, old, new, 100.0 * (new - old) / old))
+
+
+if __name__ == "__main__":
+    sys.exit(main())